@@ -15,7 +15,7 @@
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
 import os, time, datetime, calendar, urllib2
-import boto, boto.sqs, boto.s3, boto.ec2
+import boto, boto.sqs, boto.sqs.message, boto.s3, boto.ec2
 import boto.utils
 from brenda import utils
 from brenda.error import ValueErrorRetry
@@ -92,13 +92,15 @@ def s3_get(conf, s3url, dest, etag=None):
     url = k.generate_url(600, force_http=True)
     return paracurl.download(dest, url, **paracurl_kw)
 
-def put_s3_file(bucktup, path, s3name):
+def put_s3_file(bucktup, path, s3name, md5=None):
     """
-    bucktup is the return tuple of get_s3_output_bucket_name
+    bucktup is the return tuple of get_s3_output_bucket_name,
+    md5 is an optional (hex, base64) tuple, as returned by
+    boto.s3.key.Key.compute_md5
     """
     k = boto.s3.key.Key(bucktup[0])
     k.key = bucktup[1][1] + s3name
-    k.set_contents_from_filename(path, reduced_redundancy=True)
+    k.set_contents_from_filename(path, reduced_redundancy=True, md5=md5)
 
 def format_s3_url(bucktup, s3name):
     """
@@ -125,38 +127,150 @@ def get_s3_output_bucket(conf):
     buck = conn.get_bucket(bn[0])
     return buck, bn
 
+def list_s3_output_names(conf):
+    """
+    Return the names of all objects directly under the RENDER_OUTPUT
+    bucket/prefix, relative to the prefix (i.e. the s3name values
+    passed to put_s3_file by brenda-node).
+    """
+    buck, bn = get_s3_output_bucket(conf)
+    plen = len(bn[1])
+    return [k.name[plen:] for k in buck.list(prefix=bn[1], delimiter='/')
+            if isinstance(k, boto.s3.key.Key)]
+
 def parse_sqs_url(url):
     if url.startswith('sqs://'):
         return url[6:]
 
-def get_sqs_work_queue_name(conf):
-    qname = conf.get('WORK_QUEUE')
-    if not qname:
+def get_sqs_work_queue_lanes(conf):
+    """
+    WORK_QUEUE may name several queues (lanes), highest priority
+    first, each with an optional weight, e.g.
+      sqs://urgent:5,sqs://normal:1
+    Returns a list of (queue_name, weight) tuples, where weight
+    is None if not given.
+    """
+    wq = conf.get('WORK_QUEUE')
+    if not wq:
         raise ValueError("WORK_QUEUE not defined in configuration")
-    qname = parse_sqs_url(qname)
-    if not qname:
-        raise ValueError("WORK_QUEUE must be an sqs:// URL")
-    return qname
-
-def create_sqs_queue(conf):
+    lanes = []
+    for lane in wq.split(','):
+        lane = lane.strip()
+        weight = None
+        if lane.count(':') == 2:
+            lane, weight = lane.rsplit(':', 1)
+            try:
+                weight = int(weight)
+                if weight <= 0:
+                    raise ValueError()
+            except ValueError:
+                raise ValueError("WORK_QUEUE lane weight must be a positive integer: %r" % (wq,))
+        qname = parse_sqs_url(lane)
+        if not qname:
+            raise ValueError("WORK_QUEUE must be an sqs:// URL or a comma-separated list of sqs:// URLs")
+        lanes.append((qname, weight))
+    return lanes
+
+def get_sqs_work_queue_names(conf):
+    return [qname for qname, weight in get_sqs_work_queue_lanes(conf)]
+
+def get_sqs_work_queue_name(conf, lane=None):
+    """
+    Return the name of the work queue of the given lane,
+    or of the first (highest priority) lane if lane is None.
+    """
+    qnames = get_sqs_work_queue_names(conf)
+    if lane is None:
+        return qnames[0]
+    if lane not in qnames:
+        raise ValueError("lane %r is not one of the WORK_QUEUE lanes %r" % (lane, qnames))
+    return lane
+
+def create_sqs_queue(conf, lane=None):
     visibility_timeout = int(conf.get('VISIBILITY_TIMEOUT', '120'))
-    qname = get_sqs_work_queue_name(conf)
+    qname = get_sqs_work_queue_name(conf, lane)
     conn = get_sqs_conn(conf)
     return conn.create_queue(qname, visibility_timeout=visibility_timeout)
 
-def get_sqs_conn_queue(conf):
-    qname = get_sqs_work_queue_name(conf)
+def get_sqs_conn_queue(conf, lane=None):
+    qname = get_sqs_work_queue_name(conf, lane)
     conn = get_sqs_conn(conf)
     return conn.get_queue(qname), conn
 
-def get_sqs_queue(conf):
-    return get_sqs_conn_queue(conf)[0]
+def get_sqs_queue(conf, lane=None):
+    return get_sqs_conn_queue(conf, lane)[0]
+
+def get_sqs_dead_letter_queue_name(conf, qname):
+    """
+    Return the name of the dead-letter queue that poison tasks
+    of work queue qname are moved to: DEAD_LETTER_QUEUE if
+    defined, otherwise qname with a "-dead" suffix.
+    """
+    dlq = conf.get('DEAD_LETTER_QUEUE')
+    if dlq:
+        dlq = parse_sqs_url(dlq)
+        if not dlq:
+            raise ValueError("DEAD_LETTER_QUEUE must be an sqs:// URL")
+        return dlq
+    return qname + '-dead'
+
+def create_sqs_dead_letter_queue(conf, qname):
+    conn = get_sqs_conn(conf)
+    return conn.create_queue(get_sqs_dead_letter_queue_name(conf, qname))
+
+def get_sqs_dead_letter_queue(conf, qname):
+    conn = get_sqs_conn(conf)
+    return conn.get_queue(get_sqs_dead_letter_queue_name(conf, qname))
 
 def write_sqs_queue(string, queue):
     m = boto.sqs.message.Message()
     m.set_body(string)
     queue.write(m)
 
+# SendMessageBatch limits
+SQS_BATCH_MAX_MESSAGES = 10
+SQS_BATCH_MAX_BYTES = 262144
+
+# SQS limit on the (encoded) size of a message
+SQS_MAX_MESSAGE_BYTES = 262144
+
+def encode_sqs_body(string):
+    """
+    Return string in the encoded form that boto.sqs.message.Message
+    would write to SQS, so that batched messages are read back by
+    brenda-node exactly like messages written by write_sqs_queue.
+    """
+    m = boto.sqs.message.Message()
+    m.set_body(string)
+    return m.get_body_encoded()
+
+def sqs_batch_iterator(bodies):
+    """
+    Group encoded message bodies into lists that fit
+    within the SendMessageBatch count and size limits.
+    """
+    batch = []
+    size = 0
+    for body in bodies:
+        if batch and (len(batch) >= SQS_BATCH_MAX_MESSAGES or size + len(body) > SQS_BATCH_MAX_BYTES):
+            yield batch
+            batch = []
+            size = 0
+        batch.append(body)
+        size += len(body)
+    if batch:
+        yield batch
+
+def write_sqs_queue_batch(bodies, queue):
+    """
+    Write a list of encoded message bodies (see encode_sqs_body)
+    to queue using a single SendMessageBatch request.  Returns
+    the list of bodies that SQS did not accept.
+    """
+    entries = [(str(i), body, 0) for i, body in enumerate(bodies)]
+    res = queue.write_batch(entries)
+    return [bodies[int(e['id'])] for e in res.errors]
+
 def get_ec2_instances_from_conn(conn, instance_ids=None):
     reservations = conn.get_all_instances(instance_ids=instance_ids)
     return [i for r in reservations for i in r.instances]
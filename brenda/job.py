@@ -0,0 +1,206 @@
+# Brenda -- Blender render tool for Amazon Web Services
+# Copyright (C) 2013 James Yonan <james@openvpn.net>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+# Compact task messages.  Rather than a fully expanded task script,
+# each SQS message holds a small task record: a job ID plus the macro
+# values of the task.  The task script template of the job is stored
+# once in the job store (JOB_STORE, an S3 bucket/prefix) and is
+# expanded by brenda-node.  Messages that don't start with
+# TASK_RECORD_MAGIC are full task scripts, as before.  The record is
+# a one-line shell command that exits with an error, so that a node
+# that predates task records, and runs the message as a script, fails
+# the task rather than committing it with no output.
+#
+# Task records may also declare dependent tasks.  A record's 'then'
+# list holds, for each dependent, its ID, its number of prerequisites
+# 'n' and its own task record.  When a prerequisite commits, brenda-node
+# writes a done marker for it under the dependent in the job store, and
+# the node that sees all n markers releases the dependent to the work
+# queue.  The markers make dependency state durable across node
+# failures.  Release is at-least-once, so dependent tasks, like all
+# brenda tasks, should be idempotent.
+#
+# A node counts the markers of a dependent by listing them, so a
+# dependent with more than FAN_IN prerequisites is given a tree of
+# gates (see fan_in()).  A gate is a dependent that runs no task:
+# once its own prerequisites are done, it is marked done for its
+# dependents in turn.
+
+import time, random, json
+import boto, boto.exception
+from brenda import aws, error
+
+TASK_RECORD_MAGIC = "exit 65 # brenda-task "
+
+# name of the main task script template of a job
+TASK_SCRIPT = 'task-script'
+
+# maximum number of prerequisites of a dependent or gate, so
+# that its done markers fit in one S3 list page
+FAN_IN = 1000
+
+def new_job_id():
+    return "%s-%06x" % (time.strftime("%Y%m%d-%H%M%S", time.gmtime()), random.getrandbits(24))
+
+def get_job_store_name(conf):
+    """
+    Return [BUCKET, PREFIX] of the job store, which defaults
+    to the brenda-jobs/ prefix of the RENDER_OUTPUT bucket.
+    """
+    js = conf.get('JOB_STORE')
+    if js:
+        bn = aws.parse_s3_url(js)
+        if not bn:
+            raise ValueError("JOB_STORE must be an s3:// URL")
+        if len(bn) == 1:
+            bn.append('')
+        elif bn[1] and bn[1][-1] != '/':
+            bn[1] += '/'
+    else:
+        bn = [aws.get_s3_output_bucket_name(conf)[0], 'brenda-jobs/']
+    return bn
+
+def get_job_store(conf):
+    bn = get_job_store_name(conf)
+    conn = aws.get_s3_conn(conf)
+    buck = conn.get_bucket(bn[0])
+    return buck, bn
+
+def job_key_name(bucktup, job_id, name):
+    return "%s%s/%s" % (bucktup[1][1], job_id, name)
+
+def job_key(bucktup, job_id, name):
+    k = boto.s3.key.Key(bucktup[0])
+    k.key = job_key_name(bucktup, job_id, name)
+    return k
+
+def put_job_template(conf, job_id, script, name=TASK_SCRIPT):
+    bucktup = get_job_store(conf)
+    k = job_key(bucktup, job_id, name)
+    print "PUT job template", aws.format_s3_url(bucktup, k.key[len(bucktup[1][1]):])
+    k.set_contents_from_string(script)
+
+def get_job_template(conf, job_id, name=TASK_SCRIPT):
+    def fetch():
+        bucktup = get_job_store(conf)
+        return job_key(bucktup, job_id, name).get_contents_as_string()
+    return retry_job_store(conf, fetch)
+
+def retry_job_store(conf, action):
+    """
+    Run action with error.retry, also retrying S3 server errors.
+    """
+    def do_action():
+        try:
+            return action()
+        except boto.exception.S3ResponseError, e:
+            if e.status >= 500:
+                raise error.ValueErrorRetry("job store: %s" % (e,))
+            raise
+    return error.retry(conf, do_action)
+
+# pseudo job ID under which quarantine records too large
+# for the dead-letter queue are stored
+DEAD_LETTER_JOB = 'dead-letter'
+
+def task_record(job_id, macros, **fields):
+    """
+    Return a task record of job_id with the given macro values.
+    Optional fields are:
+      id     -- task ID, unique within the job (needed by tasks
+                that have dependents).
+      script -- name of the job template to expand, default
+                TASK_SCRIPT.
+      then   -- list of dependents, see dependent().
+    """
+    record = {'job' : job_id, 'macros' : macros}
+    record.update(fields)
+    return record
+
+def dependent(record, n_prereqs):
+    """
+    Return the entry in the 'then' list of a prerequisite task
+    record for the dependent task record, which is released once
+    all n_prereqs of its prerequisites have committed.
+    """
+    return {'id' : record['id'], 'n' : n_prereqs, 'record' : record}
+
+def fan_in(record, n_prereqs, i, level=0):
+    """
+    Return the entry in the 'then' list of the i'th of n_prereqs
+    prerequisites of the dependent task record.  If there are more
+    than FAN_IN prerequisites, the entry is a gate for a group of
+    FAN_IN of them, which is in turn a prerequisite of the
+    dependent (or of a gate of the next level).
+    """
+    if n_prereqs <= FAN_IN:
+        return dependent(record, n_prereqs)
+    n_gates = (n_prereqs + FAN_IN - 1) // FAN_IN
+    g = i // FAN_IN
+    gate = task_record(record['job'], {},
+                       id="%s-gate%d-%d" % (record['id'], level, g),
+                       gate=True,
+                       then=[fan_in(record, n_gates, g, level+1)])
+    return dependent(gate, min(FAN_IN, n_prereqs - g * FAN_IN))
+
+def encode_task_record(record):
+    return TASK_RECORD_MAGIC + json.dumps(record, sort_keys=True, separators=(',', ':'))
+
+def decode_task_record(body):
+    """
+    Return the task record in message body as a dictionary,
+    or None if body is an old-style full task script.
+    """
+    if body.startswith(TASK_RECORD_MAGIC):
+        record = json.loads(body[len(TASK_RECORD_MAGIC):])
+        # json returns unicode, but task scripts are byte strings
+        record['job'] = record['job'].encode('utf-8')
+        record['script'] = record.get('script', TASK_SCRIPT).encode('utf-8')
+        record['macros'] = dict([(k.encode('utf-8'), v.encode('utf-8')) for k, v in record['macros'].iteritems()])
+        return record
+
+def release_dependents(conf, record, queue):
+    """
+    Called by brenda-node after the outputs of the task described
+    by record have been committed to S3, but before its message is
+    deleted, so that a node failure in between causes the task to
+    rerun rather than its dependents to be lost.  Marks the task as
+    done for each of its dependents, and pushes to queue those
+    dependents whose prerequisites are now all done.  S3 server
+    errors are retried, and raise ValueError if they persist.
+    """
+    def release(bucktup, record):
+        buck = bucktup[0]
+        for dep in record.get('then', ()):
+            done_prefix = job_key_name(bucktup, record['job'], "done/%s/" % (dep['id'],))
+            k = boto.s3.key.Key(buck)
+            k.key = done_prefix + record['id']
+            k.set_contents_from_string('')
+
+            n_done = len(list(buck.list(prefix=done_prefix)))
+            print "******* DEPENDENT %s: %d/%d prerequisites done" % (dep['id'], n_done, dep['n'])
+            if n_done >= dep['n']:
+                rk = job_key(bucktup, record['job'], "released/%s" % (dep['id'],))
+                if buck.get_key(rk.key) is None:
+                    if dep['record'].get('gate'):
+                        release(bucktup, dep['record'])
+                    else:
+                        aws.write_sqs_queue(encode_task_record(dep['record']), queue)
+                    rk.set_contents_from_string('')
+                    print "******* DEPENDENT %s RELEASED" % (dep['id'],)
+
+    if record.get('then'):
+        retry_job_store(conf, lambda : release(get_job_store(conf), record))
@@ -14,9 +14,9 @@
 # You should have received a copy of the GNU General Public License
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
-import os, sys, signal, subprocess, multiprocessing, stat, time
+import os, sys, signal, subprocess, multiprocessing, stat, time, socket, json, threading, collections
 import paracurl
-from brenda import aws, utils, error
+from brenda import aws, utils, error, work, job, upload, shard, transcode
 
 class State(object):
     pass
@@ -30,7 +30,33 @@ class Subprocess(subprocess.Popen):
         self.terminate()
         return self.wait()
 
+    def tee_stderr(self, n_lines):
+        """
+        For a process started with stderr=subprocess.PIPE, copy
+        its stderr to our stdout, retaining the last n_lines.
+        """
+        def reader():
+            for line in iter(self.stderr.readline, ''):
+                sys.stdout.write(line)
+                self._stderr_tail.append(line)
+
+        self._stderr_tail = collections.deque(maxlen=n_lines)
+        self._stderr_thread = threading.Thread(target=reader)
+        self._stderr_thread.daemon = True
+        self._stderr_thread.start()
+
+    def stderr_tail(self):
+        self._stderr_thread.join(5)
+        return ''.join(self._stderr_tail)
+
 class Multiprocess(multiprocessing.Process):
+    def run(self):
+        # The child inherits the node's signal handlers, which would
+        # clean up the node's tasks when the child is terminated.
+        signal.signal(signal.SIGINT, signal.SIG_DFL)
+        signal.signal(signal.SIGTERM, signal.SIG_DFL)
+        multiprocessing.Process.run(self)
+
     def stop(self):
         if self.is_alive():
             self.terminate()
@@ -40,23 +66,544 @@ class Multiprocess(multiprocessing.Process):
     def poll(self):
         return self.exitcode
 
-def start_s3_push_process(opts, args, conf, outdir):
-    p = Multiprocess(target=s3_push_process, args=(opts, args, conf, outdir))
+class WorkQueues(object):
+    """
+    Reads tasks from the lanes of WORK_QUEUE.  If no lane has
+    a weight, lanes are polled in strict priority order.  Otherwise
+    each read starts with the lane chosen by smooth weighted
+    round-robin (lanes without a weight have weight 1), falling
+    back to the other lanes in priority order when it is empty,
+    so that low-priority work keeps the node busy without starving
+    urgent work.  Messages returned by read() remember their own
+    queue, so they can be deleted with msg.delete().
+    """
+
+    # SQS limit on messages returned by one receive
+    MAX_READ = 10
+
+    # seconds between lookups of lanes that don't exist yet
+    LANE_RECHECK = 60
+
+    def __init__(self, conf):
+        self.conf = conf
+        lanes = aws.get_sqs_work_queue_lanes(conf)
+        self.lanes = [qname for qname, w in lanes]
+        self.weighted = bool([w for qname, w in lanes if w is not None])
+        self.weights = [w or 1 for qname, w in lanes]
+        self.queues = [None] * len(self.lanes)
+        self.current = [0] * len(self.lanes)
+        self.next_lookup = 0
+        self.lookup()
+
+    def lookup(self):
+        # Look up lanes that didn't exist at the last lookup, so
+        # that a lane created after the node started is polled too.
+        now = time.time()
+        if now < self.next_lookup:
+            return
+        first = not self.next_lookup
+        self.next_lookup = now + self.LANE_RECHECK
+        for i, qname in enumerate(self.lanes):
+            if self.queues[i] is None:
+                self.queues[i] = aws.get_sqs_queue(self.conf, qname)
+                if self.queues[i] is not None and not first:
+                    print "******* WORK_QUEUE lane %r now exists, polling it" % (qname,)
+                elif self.queues[i] is None and first:
+                    print "******* WORK_QUEUE lane %r does not exist, ignoring until it is created" % (qname,)
+
+    def order(self):
+        live = [i for i, q in enumerate(self.queues) if q is not None]
+        if not self.weighted or len(live) < 2:
+            return [self.queues[i] for i in live]
+        total = sum([self.weights[i] for i in live])
+        for i in live:
+            self.current[i] += self.weights[i]
+        sel = max(live, key=lambda i : self.current[i])
+        self.current[sel] -= total
+        return [self.queues[sel]] + [self.queues[i] for i in live if i != sel]
+
+    def read(self, n=1, wait=0, visibility_timeout=None):
+        """
+        Return a list of up to n messages, taken from the
+        lanes in the order given by order().  If all lanes are
+        empty and wait is nonzero, long-poll the lanes for up
+        to wait seconds in total (or just sleep, if no lane
+        exists yet).
+        """
+        self.lookup()
+        ret = []
+        n = min(n, self.MAX_READ)
+        queues = self.order()
+        for q in queues:
+            ret += q.get_messages(n - len(ret), visibility_timeout=visibility_timeout,
+                                  attributes='ApproximateReceiveCount')
+            if len(ret) >= n:
+                break
+        if not ret and wait and not queues:
+            time.sleep(wait)
+        elif not ret and wait:
+            lane_wait = max(wait // len(queues), 1)
+            for q in queues:
+                ret = q.get_messages(n, visibility_timeout=visibility_timeout,
+                                     attributes='ApproximateReceiveCount',
+                                     wait_time_seconds=lane_wait)
+                if ret:
+                    break
+        return ret
+
+def read_meminfo():
+    """
+    Return /proc/meminfo as a dictionary of byte counts,
+    or None if not available.
+    """
+    try:
+        info = {}
+        with open('/proc/meminfo') as f:
+            for line in f:
+                fields = line.split()
+                if len(fields) >= 2:
+                    info[fields[0].rstrip(':')] = int(fields[1]) * 1024
+        return info
+    except (IOError, ValueError):
+        return None
+
+def process_tree_rss(root_pids):
+    """
+    Return a dictionary that maps each pid in root_pids to the
+    total resident set size in bytes of the process and all of
+    its descendants.
+    """
+    page_size = os.sysconf('SC_PAGE_SIZE')
+    children = collections.defaultdict(list)
+    rss = {}
+    for fn in os.listdir('/proc'):
+        if not fn.isdigit():
+            continue
+        try:
+            with open('/proc/%s/stat' % (fn,)) as f:
+                stat_line = f.read()
+            with open('/proc/%s/statm' % (fn,)) as f:
+                statm = f.read()
+        except IOError:
+            continue # process exited
+        # command name may contain spaces, so parse fields after it
+        ppid = int(stat_line[stat_line.rindex(')')+2:].split()[1])
+        pid = int(fn)
+        children[ppid].append(pid)
+        rss[pid] = int(statm.split()[1]) * page_size
+    ret = {}
+    for root in root_pids:
+        total = 0
+        stack = [root]
+        while stack:
+            pid = stack.pop()
+            total += rss.get(pid, 0)
+            stack.extend(children.get(pid, ()))
+        ret[root] = total
+    return ret
+
+class MemoryBudget(object):
+    """
+    Admission control for concurrent render slots.  The peak
+    resident memory of each active task's process tree is sampled
+    while it runs, and a per-job estimate of task peak memory is
+    kept (raised at once by a larger peak, lowered gradually by
+    smaller ones).  Another task is admitted only if available
+    memory, less MEMORY_RESERVE and the growth still expected from
+    running tasks, covers the estimate for the job of the task to
+    be admitted.  While swap use is growing, no tasks are admitted.
+    """
+
+    def __init__(self, conf):
+        self.reserve = int(conf.get('MEMORY_RESERVE', '512')) * 1024 * 1024
+        self.default_estimate = int(conf.get('TASK_MEMORY', '0')) * 1024 * 1024 or None
+        self.estimates = {}
+        self.swap_used = None
+        self.status = None
+
+    @staticmethod
+    def job_of(task):
+        if task.record is not None:
+            return task.record['job']
+
+    def estimate(self, job_id):
+        return self.estimates.get(job_id, self.default_estimate)
+
+    def sample(self, tasks):
+        tasks = [t for t in tasks if t.proc is not None]
+        if tasks:
+            rss = process_tree_rss([t.proc.pid for t in tasks])
+            for t in tasks:
+                t.rss = rss[t.proc.pid]
+                t.peak_rss = max(t.peak_rss, t.rss)
+
+    def update(self, task):
+        if not task.peak_rss:
+            return
+        job_id = self.job_of(task)
+        est = self.estimates.get(job_id)
+        if est is None or task.peak_rss > est:
+            est = task.peak_rss
+        else:
+            est = (3 * est + task.peak_rss) // 4
+        self.estimates[job_id] = est
+        print "******* TASK %d PEAK RSS %d MB, job %s estimate %d MB" % (
+            task.id, task.peak_rss >> 20, job_id, est >> 20)
+
+    def admit(self, running, job_id):
+        """
+        Return True if another task of job_id may start
+        alongside the running active tasks.
+        """
+        if not running:
+            return True
+        info = read_meminfo()
+        if info is None:
+            return True
+        avail = info.get('MemAvailable')
+        if avail is None:
+            avail = info.get('MemFree', 0) + info.get('Buffers', 0) + info.get('Cached', 0)
+        swap_used = info.get('SwapTotal', 0) - info.get('SwapFree', 0)
+        swapping = self.swap_used is not None and swap_used > self.swap_used
+        self.swap_used = swap_used
+
+        est = self.estimate(job_id)
+        if swapping:
+            status = "swap use is growing"
+        elif est is None:
+            status = "no memory estimate yet for job %s" % (job_id,)
+        else:
+            growth = sum([max((self.estimate(self.job_of(t)) or t.peak_rss) - t.rss, 0) for t in running])
+            budget = avail - self.reserve - growth
+            if budget >= est:
+                status = None
+            else:
+                status = "need %d MB, budget %d MB" % (est >> 20, budget >> 20)
+        if status != self.status:
+            self.status = status
+            if status:
+                print "******* MEMORY ADMISSION: holding new tasks,", status
+            else:
+                print "******* MEMORY ADMISSION: admitting new tasks"
+        return status is None
+
+class LeaseManager(threading.Thread):
+    """
+    Keeps the SQS messages held by the node leased from a thread of
+    its own, with its own SQS connection, so that a slow S3 push or
+    a blocked task loop can't let a lease lapse.  A lease is renewed
+    when it has less than VISIBILITY_TIMEOUT - VISIBILITY_TIMEOUT_REASSERT
+    seconds left, for VISIBILITY_TIMEOUT plus the predicted remaining
+    render time of its task (from a per-job running average of render
+    times), so long renders need few renewals.  Due renewals are
+    batched per queue with ChangeMessageVisibilityBatch.  If the task
+    loop stops calling heartbeat() for LEASE_STALL_TIMEOUT seconds,
+    leases are left to expire so that SQS hands the tasks to another
+    node.
+
+    Messages of completed tasks are passed to acknowledge(), and
+    deleted with DeleteMessageBatch once a batch of 10 is ready for
+    a queue, SQS_ACK_DELAY seconds after the first of them, or when
+    one of them nears its visibility deadline, whichever is first.
+    Failed deletes are retried until the deadline.  stop() flushes
+    the remaining acknowledgements.
+    """
+
+    # SQS limit on visibility, counted from receipt of the message
+    MAX_VISIBILITY = 43200
+
+    def __init__(self, conf, visibility_timeout, reassert):
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self.conf = conf
+        self.visibility_timeout = visibility_timeout
+        self.renew_margin = max(visibility_timeout - reassert, 1)
+        self.stall_timeout = int(conf.get('LEASE_STALL_TIMEOUT', '900'))
+        self.lock = threading.Lock()
+        self.leases = {}
+        self.acks = {}
+        self.ack_delay = float(conf.get('SQS_ACK_DELAY', '2'))
+        self.render_times = {}
+        self.beat = time.time()
+        self.stalled = False
+        self.halt = threading.Event()
+        self.conn = None
+
+    def hold(self, msg):
+        """
+        Start leasing msg, which was received with a visibility
+        timeout of VISIBILITY_TIMEOUT.
+        """
+        lease = State()
+        lease.msg = msg
+        lease.received = time.time()
+        lease.deadline = lease.received + self.visibility_timeout
+        lease.job = None
+        lease.start = None
+        with self.lock:
+            self.leases[msg.receipt_handle] = lease
+
+    def release(self, msg):
+        with self.lock:
+            self.leases.pop(msg.receipt_handle, None)
+
+    def acknowledge(self, msg):
+        """
+        Stop leasing msg, and delete it from its queue
+        (batched with other acknowledgements).
+        """
+        with self.lock:
+            lease = self.leases.pop(msg.receipt_handle, None)
+            if lease is None:
+                lease = State()
+                lease.msg = msg
+                lease.deadline = time.time() + self.visibility_timeout
+            lease.acked = time.time()
+            self.acks[msg.receipt_handle] = lease
+
+    def started(self, msg, job_id):
+        with self.lock:
+            lease = self.leases.get(msg.receipt_handle)
+            if lease:
+                lease.job = job_id
+                lease.start = time.time()
+
+    def rendered(self, msg):
+        with self.lock:
+            lease = self.leases.get(msg.receipt_handle)
+            if lease and lease.start is not None:
+                t = time.time() - lease.start
+                avg = self.render_times.get(lease.job)
+                self.render_times[lease.job] = t if avg is None else (3 * avg + t) / 4
+                lease.start = None
+
+    def heartbeat(self):
+        self.beat = time.time()
+
+    def stop(self):
+        self.halt.set()
+        self.join()
+
+    def remaining(self, lease, now):
+        avg = self.render_times.get(lease.job)
+        if lease.start is None or avg is None:
+            return 0
+        return max(int(avg - (now - lease.start)), 0)
+
+    def renew(self):
+        now = time.time()
+        if now - self.beat > self.stall_timeout:
+            if not self.stalled:
+                print "******* LEASE task loop stalled, letting leases expire"
+                self.stalled = True
+            return
+        self.stalled = False
+
+        # collect due renewals, grouped by queue
+        batches = {}
+        with self.lock:
+            for lease in self.leases.values():
+                if lease.deadline - now < self.renew_margin:
+                    timeout = self.visibility_timeout + self.remaining(lease, now)
+                    timeout = min(timeout, self.MAX_VISIBILITY - int(now - lease.received) - 1)
+                    if timeout > 0:
+                        q = lease.msg.queue
+                        batches.setdefault(q.name, (q, []))[1].append((lease, timeout))
+
+        for q, renewals in batches.values():
+            for i in xrange(0, len(renewals), aws.SQS_BATCH_MAX_MESSAGES):
+                batch = renewals[i:i+aws.SQS_BATCH_MAX_MESSAGES]
+                if self.conn is None:
+                    self.conn = aws.get_sqs_conn(self.conf)
+                res = self.conn.change_message_visibility_batch(q, [(lease.msg, timeout) for lease, timeout in batch])
+                failed = dict([(e['id'], e.get('message')) for e in res.errors])
+                for lease, timeout in batch:
+                    if lease.msg.id in failed:
+                        print "******* LEASE RENEW FAILED", lease.msg.id, failed[lease.msg.id]
+                    else:
+                        print "******* LEASE RENEW", lease.msg.id, timeout
+                        lease.deadline = now + timeout
+
+    def flush_acks(self, force=False):
+        now = time.time()
+
+        # collect acknowledgements, grouped by queue
+        batches = {}
+        with self.lock:
+            for lease in self.acks.values():
+                if lease.deadline <= now:
+                    print "******* ACK EXPIRED", lease.msg.id, "task may be run again"
+                    del self.acks[lease.msg.receipt_handle]
+                    continue
+                q = lease.msg.queue
+                batches.setdefault(q.name, (q, []))[1].append(lease)
+
+        for q, acks in batches.values():
+            due = (force or len(acks) >= aws.SQS_BATCH_MAX_MESSAGES
+                   or [lease for lease in acks if now - lease.acked >= self.ack_delay
+                       or lease.deadline - now < self.renew_margin])
+            if not due:
+                continue
+            for i in xrange(0, len(acks), aws.SQS_BATCH_MAX_MESSAGES):
+                batch = acks[i:i+aws.SQS_BATCH_MAX_MESSAGES]
+                if self.conn is None:
+                    self.conn = aws.get_sqs_conn(self.conf)
+                res = self.conn.delete_message_batch(q, [lease.msg for lease in batch])
+                failed = dict([(e['id'], e.get('message')) for e in res.errors])
+                with self.lock:
+                    for lease in batch:
+                        if lease.msg.id in failed:
+                            print "******* ACK FAILED", lease.msg.id, failed[lease.msg.id]
+                        else:
+                            self.acks.pop(lease.msg.receipt_handle, None)
+                print "******* ACK %d tasks on %s" % (len(batch) - len(failed), q.name)
+
+    def run(self):
+        while not self.halt.wait(1):
+            for action in (self.renew, self.flush_acks):
+                try:
+                    action()
+                except Exception, e:
+                    print "******* LEASE EXCEPTION", e
+                    self.conn = None
+
+        # acknowledge remaining tasks before exit
+        for i in xrange(3):
+            if not self.acks:
+                break
+            try:
+                self.flush_acks(force=True)
+            except Exception, e:
+                print "******* LEASE EXCEPTION", e
+                self.conn = None
+
+def task_is_retry(msg):
+    """
+    Return True if msg has been received before, in which case
+    some of its output may already be in S3.
+    """
+    return int(msg.attributes.get('ApproximateReceiveCount', '1')) > 1
+
+def start_s3_push_process(opts, args, conf, outdir, retry=False):
+    p = Multiprocess(target=s3_push_process, args=(opts, args, conf, outdir, retry))
     p.start()
     return p
 
-def s3_push_process(opts, args, conf, outdir):
-    def do_s3_push():
-        bucktup = aws.get_s3_output_bucket(conf)
+def s3_push_process(opts, args, conf, outdir, retry):
+    try:
+        files = []
         for dirpath, dirnames, filenames in os.walk(outdir):
             for f in filenames:
-                path = os.path.join(dirpath, f)
-                print "PUSH", path, "TO", aws.format_s3_url(bucktup, f)
-                aws.put_s3_file(bucktup, path, f)
+                files.append((os.path.join(dirpath, f), f))
             break
+        files = transcode.Transcoder(conf, outdir).transcode(files)
+        if int(conf.get('SHARD_OUTPUT', '0')):
+            files = shard.pack(files, os.path.join(outdir, '.brenda-shards'),
+                               int(conf.get('SHARD_SIZE', '0')) * upload.MB)
+        upload.Uploader(conf, retry).upload(files)
+    except Exception, e:
+        print "S3 push failed:", e
+        sys.exit(1)
+    sys.exit(0)
+
+# log of the objects pushed by a streaming push process,
+# relative to the output directory of its task
+STREAM_LOG = os.path.join('.brenda-stream', 'pushed')
+
+def start_s3_stream_process(opts, args, conf, outdir, retry=False):
+    """
+    Start a process that pushes files to S3 as soon as the
+    active task closes them in outdir.  Once the task has
+    finished, call render_done.set(), and the process exits
+    when the remaining files have been pushed.  If the task
+    fails instead, stop the process and call
+    delete_streamed_output.
+    """
+    utils.mkdir(os.path.dirname(os.path.join(outdir, STREAM_LOG)))
+
+    # watch outdir before the task starts, so that no events are missed
+    try:
+        ino = upload.Inotify()
+        ino.add_watch(outdir, upload.Inotify.IN_CLOSE_WRITE|upload.Inotify.IN_MOVED_TO)
+    except OSError, e:
+        print "Streaming push not available, pushing after task:", e
+        ino = None
+
+    render_done = multiprocessing.Event()
+    p = Multiprocess(target=s3_stream_process, args=(opts, args, conf, outdir, retry, ino, render_done))
+    p.render_done = render_done
+    p.start()
+    if ino:
+        ino.close()
+    return p
+
+def delete_streamed_output(conf, outdir):
+    """
+    Delete the objects that the streaming push process of a failed
+    task wrote to RENDER_OUTPUT.  A task that crashes still closes
+    its files, so they may hold partial output under final names.
+    """
+    try:
+        with open(os.path.join(outdir, STREAM_LOG)) as f:
+            names = sorted(set([line.rstrip('\n') for line in f]))
+    except IOError:
+        return
+    if names:
+        bucktup = error.retry(conf, lambda : aws.get_s3_output_bucket(conf))
+        print "DELETE %d streamed objects from %s" % (len(names), aws.format_s3_url(bucktup, ''))
+        error.retry(conf, lambda : bucktup[0].delete_keys([bucktup[1][1] + name for name in names]))
+
+def s3_stream_process(opts, args, conf, outdir, retry, ino, render_done):
+    def outdir_files():
+        for dirpath, dirnames, filenames in os.walk(outdir):
+            return filenames
+        return []
+
+    def file_stat(fn):
+        st = os.stat(os.path.join(outdir, fn))
+        return st.st_size, st.st_mtime
+
+    def push(fn):
+        path = os.path.join(outdir, fn)
+        if fn not in pushed and os.path.isfile(path):
+            pushed[fn] = file_stat(fn)
+            if transcoder.codec(fn):
+                transcoder.submit(path, fn)
+            else:
+                uploader.put(path, fn)
 
     try:
-        error.retry(conf, do_s3_push)
+        pushed_log = os.path.join(outdir, STREAM_LOG)
+        uploader = upload.Uploader(conf, retry, pushed_log)
+        transcoder = transcode.Transcoder(conf, outdir)
+        pushed = {}
+
+        # push files as they are closed, until the task has finished
+        while True:
+            finished = render_done.is_set()
+            if ino:
+                for fn in ino.read(1):
+                    push(fn)
+            elif not finished:
+                render_done.wait(1)
+            for path, s3name in transcoder.results():
+                uploader.put(path, s3name)
+            if finished:
+                break
+
+        # push files that we missed events for
+        for fn in outdir_files():
+            push(fn)
+        for path, s3name in transcoder.finish():
+            uploader.put(path, s3name)
+        uploader.finish()
+
+        # Files rewritten after they were pushed are pushed again,
+        # now that the earlier upload can't overwrite them.
+        changed = [(os.path.join(outdir, fn), fn) for fn in outdir_files()
+                   if fn in pushed and file_stat(fn) != pushed[fn]]
+        if changed:
+            upload.Uploader(conf, retry, pushed_log).upload(transcoder.transcode(changed))
     except Exception, e:
         print "S3 push failed:", e
         sys.exit(1)
@@ -84,17 +631,89 @@ def run_tasks(opts, args, conf):
         # timestamp of completion of last task
         utils.write_atomic('task_last', "%d\n" % (time.time(),))
 
+    def get_job_template(job_id, name):
+        # task script templates are fetched once per job and cached
+        template = local.job_templates.get((job_id, name))
+        if template is None:
+            template = work.TaskTemplate(job.get_job_template(conf, job_id, name))
+            local.job_templates[(job_id, name)] = template
+        return template
+
+    def quarantine(task, stderr_tail):
+        # Move a failed task to the dead-letter queue of its work queue
+        # if it has been received (and presumably failed) at least
+        # max_task_failures times, so that a poison task can't burn
+        # fleet-hours forever.  Returns True if task was quarantined.
+        receive_count = int(task.msg.attributes.get('ApproximateReceiveCount', '0'))
+        print "******* TASK", task.id, "FAILED (receive count %d)" % (receive_count,)
+        if not max_task_failures or receive_count < max_task_failures:
+            return False
+        # json can't encode bytes that aren't UTF-8, so decode the
+        # body and tail first, and truncate the decoded text
+        body = task.msg.get_body()
+        if isinstance(body, str):
+            body = body.decode('utf-8', 'replace')
+        if isinstance(stderr_tail, str):
+            stderr_tail = stderr_tail.decode('utf-8', 'replace')
+        tail = stderr_tail[-(aws.SQS_BATCH_MAX_BYTES // 4):]
+        dead = {
+            'queue' : task.msg.queue.name,
+            'body' : body,
+            'receive_count' : receive_count,
+            'retcode' : task.retcode,
+            'node' : socket.gethostname(),
+            'time' : int(time.time()),
+            'stderr_tail' : tail,
+            }
+        try:
+            # Shorten the stderr tail until the record fits in a message.
+            # If the task body alone is too large, store the record in
+            # the job store, and queue a pointer to it.
+            record = json.dumps(dead)
+            while len(aws.encode_sqs_body(record)) > aws.SQS_MAX_MESSAGE_BYTES and dead['stderr_tail']:
+                dead['stderr_tail'] = dead['stderr_tail'][len(dead['stderr_tail']) // 2 + 1:]
+                record = json.dumps(dead)
+            if len(aws.encode_sqs_body(record)) > aws.SQS_MAX_MESSAGE_BYTES:
+                dead['stderr_tail'] = tail
+                name = "%s.json" % (task.msg.id,)
+                job.put_job_template(conf, job.DEAD_LETTER_JOB, json.dumps(dead), name)
+                del dead['body'], dead['stderr_tail']
+                dead['stored'] = name
+                record = json.dumps(dead)
+            dlq = aws.create_sqs_dead_letter_queue(conf, task.msg.queue.name)
+            aws.write_sqs_queue(record, dlq)
+        except Exception, e:
+            print "******* TASK", task.id, "QUARANTINE FAILED:", e
+            return False
+        local.leases.acknowledge(task.msg)
+        task.msg = None
+        print "******* TASK", task.id, "QUARANTINED to", dlq.name
+        return True
+
     def signal_handler(signal, frame):
         print "******* SIGNAL %r, exiting" % (signal,)
         cleanup_all()
         sys.exit(1)
 
     def cleanup_all():
-        tasks = (local.task_active, local.task_push)
-        local.task_active = local.task_push = None
-        for i, task in enumerate(tasks):
-            name = task_names[i]
-            cleanup(task, name)
+        pending = local.pending
+        local.pending = collections.deque()
+        for msg in pending:
+            try:
+                local.leases.release(msg)
+                msg.change_visibility(0) # immediately return task back to work queue
+            except Exception, e:
+                print "******* CLEANUP EXCEPTION sqs change_visibility pending", e
+        slots = local.slots
+        local.slots = []
+        for slot in slots:
+            task = slot.active
+            slot.active = None
+            cleanup(task, 'active')
+        uploads = local.uploads
+        local.uploads = []
+        for task in uploads:
+            cleanup(task, 'push')
 
     def cleanup(task, name):
         if task:
@@ -102,6 +721,7 @@ def run_tasks(opts, args, conf):
                 try:
                     msg = task.msg
                     task.msg = None
+                    local.leases.release(msg)
                     msg.change_visibility(0) # immediately return task back to work queue
                 except Exception, e:
                     print "******* CLEANUP EXCEPTION sqs change_visibility", name, e
@@ -112,6 +732,14 @@ def run_tasks(opts, args, conf):
                     proc.stop()
                 except Exception, e:
                     print "******* CLEANUP EXCEPTION proc stop", name, e
+            if task.watcher is not None:
+                try:
+                    watcher = task.watcher
+                    task.watcher = None
+                    watcher.stop()
+                    delete_streamed_output(conf, task.outdir)
+                except Exception, e:
+                    print "******* CLEANUP EXCEPTION watcher stop", name, e
             if task.outdir is not None:
                 try:
                     outdir = task.outdir
@@ -120,174 +748,340 @@ def run_tasks(opts, args, conf):
                 except Exception, e:
                     print "******* CLEANUP EXCEPTION rm outdir", name, task.outdir, e
 
-    def task_loop():
+    def prefetch(q, n, wait=0):
+        """
+        Read up to n messages from the work queue into local.pending,
+        long-polling for up to wait seconds if it is empty.
+        Templates of compact task records are fetched now, so that
+        tasks can start as soon as a slot is free.  Returns the number
+        of messages read.
+        """
+        msgs = q.read(n, wait, visibility_timeout) if n > 0 else []
+        for msg in msgs:
+            print "queue prefetch:", msg
+            local.leases.hold(msg)
+            local.pending.append(msg)
+            try:
+                record = job.decode_task_record(msg.get_body())
+                if record is not None:
+                    get_job_template(record['job'], record['script'])
+            except Exception, e:
+                # the task fails when started (see start_task)
+                print "******* PREFETCH EXCEPTION", msg.id, e
+        return len(msgs)
+
+    def pending_job():
+        # job ID of the next pending task (None for a full task script)
         try:
-            # reset tasks
-            local.task_active = None
-            local.task_push = None
+            record = job.decode_task_record(local.pending[0].get_body())
+        except Exception:
+            return None
+        if record is not None:
+            return record['job']
+
+    def start_task(msg, slot):
+        # initialize active task object
+        task = State()
+        task.msg = None
+        task.record = None
+        task.proc = None
+        task.watcher = None
+        task.retcode = None
+        task.outdir = None
+        task.id = 0
+        task.rss = task.peak_rss = 0
+
+        # The task is a message from the SQS work queue.  This is
+        # normally a short script that runs blender to render one
+        # or more frames.
+        task.msg = msg
+
+        # output some debug info
+        print "queue read (slot %d):" % (slot.index,), task.msg
+        print "push tasks:", len(local.uploads)
+
+        # assign an ID to task
+        local.task_id_counter += 1
+        task.id = local.task_id_counter
+
+        # register active task
+        slot.active = task
+
+        # create output directory
+        task.outdir = os.path.join(work_dir, "brenda-outdir%d.tmp" % (task.id,))
+        utils.rmtree(task.outdir)
+        utils.mkdir(task.outdir)
+
+        # get the task script
+        script = task.msg.get_body()
+        print "script len:", len(script)
+
+        # Expand compact task records using the task script template
+        # of their job.  If the record is malformed or its template
+        # can't be fetched, fail only this task.
+        try:
+            task.record = job.decode_task_record(script)
+            if task.record is not None:
+                print "job:", task.record['job'], "script:", task.record['script'], "macros:", task.record['macros']
+                script = get_job_template(task.record['job'], task.record['script']).expand(task.record['macros'])
+        except Exception, e:
+            print "******* TASK", task.id, "BAD TASK RECORD:", e
+            task.record = None
+            if not quarantine(task, "brenda-node: cannot expand task record: %s\n" % (e,)):
+                print "******* SLOT %d WAITING %d seconds..." % (slot.index, error_pause)
+                slot.resume = time.time() + error_pause
+            cleanup(task, 'active')
+            slot.active = None
+            return None
+        job_id = MemoryBudget.job_of(task)
+        local.leases.started(task.msg, job_id)
+
+        # do macro substitution on the task script
+        script = script.replace('$OUTDIR', task.outdir)
+        script = script.replace('$THREADS', str(render_threads))
+
+        # add shebang if absent
+        if not script.startswith("#!"):
+            script = "#!/bin/bash\n" + script
+
+        # cd to the slot's project directory, where we will run blender from
+        with utils.Cd(slot.proj_dir) as cd:
+            # write script file and make it executable
+            script_fn = "./brenda-go"
+            with open(script_fn, 'w') as f:
+                f.write(script)
+            st = os.stat(script_fn)
+            os.chmod(script_fn, st.st_mode | (stat.S_IEXEC|stat.S_IXGRP|stat.S_IXOTH))
+
+            # run the script
+            print "------- Run script %s -------" % (os.path.realpath(script_fn),)
+            print script,
+            print "--------------------------"
+            if stream_upload:
+                task.watcher = start_s3_stream_process(opts, args, conf, task.outdir, task_is_retry(task.msg))
+            task.proc = Subprocess([script_fn], stderr=subprocess.PIPE)
+            task.proc.tee_stderr(stderr_tail_lines)
+
+        print "active task (slot %d):" % (slot.index,), task.__dict__
+        return task
+
+    def poll_active(slot):
+        task = slot.active
+        if task and task.proc is not None:
+            # test if process has finished
+            task.retcode = task.proc.poll()
+            if task.retcode is not None:
+                # process has finished
+                proc = task.proc
+                task.proc = None
+                local.leases.rendered(task.msg)
+                if budget:
+                    budget.update(task)
+
+                # Did process finish with errors?  If so, return only
+                # this task to the work queue (unless quarantined), and
+                # pause its slot.  Other slots and pushes are unaffected.
+                if task.retcode != 0:
+                    quarantined = quarantine(task, proc.stderr_tail())
+                    cleanup(task, 'active')
+                    slot.active = None
+                    if quarantined:
+                        return
+                    slot.failures += 1
+                    print "******* SLOT %d FAILURE %d/%d: fatal error in active task" % (slot.index, slot.failures, n_retries)
+                    if slot.failures >= n_retries:
+                        raise ValueError("FAIL after %d failed tasks on slot %d" % (slot.failures, slot.index))
+                    print "******* SLOT %d WAITING %d seconds..." % (slot.index, error_pause)
+                    slot.resume = time.time() + error_pause
+                    return
+
+                slot.failures = 0
+                print "******* TASK", task.id, "READY-FOR-PUSH"
+                if task.watcher is not None:
+                    task.watcher.render_done.set()
+
+    def poll_push(task):
+        # test if process has finished, returns True if it has
+        task.retcode = task.proc.poll()
+        if task.retcode is None:
+            return False
+        task.proc = None
+
+        if task.retcode != 0:
+            # return only this task to the work queue (in cleanup below),
+            # other pending pushes are unaffected
+            print "******* TASK", task.id, "PUSH FAILED, returning task to work queue"
+        else:
+            # Process finished successfully, so tell SQS
+            # that the task completed successfully.
+            if task.record is not None:
+                try:
+                    job.release_dependents(conf, task.record, task.msg.queue)
+                except Exception, e:
+                    # like a failed push, return only this task
+                    print "******* TASK", task.id, "RELEASE FAILED, returning task to work queue:", e
+                    cleanup(task, 'push')
+                    return True
+            print "******* TASK", task.id, "COMMITTED to S3"
+            local.leases.acknowledge(task.msg)
+            task.msg = None
+            local.task_count += 1
+            task_complete_accounting(local.task_count)
+
+        # clean up the S3-push task
+        cleanup(task, 'push')
+        return True
+
+    def busy():
+        return local.uploads or [slot for slot in local.slots if slot.active]
+
+    def disk_full():
+        # True if the work dir filesystem is above the high-water mark
+        st = os.statvfs(work_dir)
+        used = 100 - (100 * st.f_bavail) // max(st.f_blocks, 1)
+        full = used >= disk_high_water
+        if full != local.disk_full:
+            local.disk_full = full
+            if full:
+                print "******* DISK %d%% full, holding new tasks" % (used,)
+            else:
+                print "******* DISK %d%% full, admitting new tasks" % (used,)
+        return full
 
-            # get SQS work queue
-            q = aws.get_sqs_queue(conf)
+    def rendering_tasks():
+        return [slot.active for slot in local.slots if slot.active and slot.active.proc is not None]
 
-            # Loop over tasks.  There are up to two different tasks at any
-            # given moment that we are processing concurrently:
+    def task_loop():
+        try:
+            # reset tasks
+            local.slots = []
+            for i in xrange(render_slots):
+                slot = State()
+                slot.index = i
+                slot.proj_dir = slot_proj_dirs[i]
+                slot.active = None
+                slot.failures = 0
+                slot.resume = 0
+                local.slots.append(slot)
+            local.uploads = []
+
+            # get SQS work queue lanes
+            q = WorkQueues(conf)
+
+            # start the lease manager, which keeps held messages leased
+            local.leases = LeaseManager(conf, visibility_timeout, visibility_timeout_reassert)
+            local.leases.start()
+
+            # Loop over tasks.  There are two kinds of tasks that we
+            # are processing concurrently:
+            #
+            # 1. Active tasks -- usually a blender render operation,
+            #                    one in each of the render_slots slots.
+            # 2. S3 push tasks -- tasks which push the products of
+            #                     completed active tasks (such as
+            #                     rendered frames) to S3.  Up to
+            #                     upload_queue_depth rendered tasks
+            #                     wait in local.uploads for their push
+            #                     to commit, and up to push_workers
+            #                     push processes run at once.
             #
-            # 1. Active task -- usually a blender render operation.
-            # 2. S3 push task -- a task which pushes the products of the
-            #                    previous active task (such as rendered
-            #                    frames) to S3.
+            # In addition, up to prefetch_tasks messages are leased
+            # ahead of time in local.pending, so that the next task
+            # starts as soon as a slot is free.
+            #
+            # The lease manager thread reasserts with SQS that the tasks
+            # of all held messages are still pending.  (If we don't
+            # reassert with SQS frequently enough, it will assume we
+            # died, and put our tasks back in the queue.)
+            next_read = 0
+            queue_empty = False
             while True:
-                # reset active task
-                local.task_active = None
-
-                # initialize active task object
-                task = State()
-                task.msg = None
-                task.proc = None
-                task.retcode = None
-                task.outdir = None
-                task.id = 0
-
-                # Get a task from the SQS work queue.  This is normally
-                # a short script that runs blender to render one
-                # or more frames.
-                task.msg = q.read()
-
-                # output some debug info
-                print "queue read:", task.msg
-                if local.task_push:
-                    print "push task:", local.task_push.__dict__
-                else:
-                    print "no task push task"
-
-                # process task
-                if task.msg is not None:
-                    # assign an ID to task
-                    local.task_id_counter += 1
-                    task.id = local.task_id_counter
-
-                    # register active task
-                    local.task_active = task
-
-                    # create output directory
-                    task.outdir = os.path.join(work_dir, "brenda-outdir%d.tmp" % (task.id,))
-                    utils.rmtree(task.outdir)
-                    utils.mkdir(task.outdir)
-
-                    # get the task script
-                    script = task.msg.get_body()
-                    print "script len:", len(script)
-
-                    # do macro substitution on the task script
-                    script = script.replace('$OUTDIR', task.outdir)
-
-                    # add shebang if absent
-                    if not script.startswith("#!"):
-                        script = "#!/bin/bash\n" + script
-
-                    # cd to project directory, where we will run blender from
-                    with utils.Cd(proj_dir) as cd:
-                        # write script file and make it executable
-                        script_fn = "./brenda-go"
-                        with open(script_fn, 'w') as f:
-                            f.write(script)
-                        st = os.stat(script_fn)
-                        os.chmod(script_fn, st.st_mode | (stat.S_IEXEC|stat.S_IXGRP|stat.S_IXOTH))
-
-                        # run the script
-                        print "------- Run script %s -------" % (os.path.realpath(script_fn),)
-                        print script,
-                        print "--------------------------"
-                        task.proc = Subprocess([script_fn])
-
-                    print "active task:", local.task_active.__dict__
-
-                # Wait for active and S3-push tasks to complete,
-                # while periodically reasserting with SQS to
-                # acknowledge that tasks are still pending.
-                # (If we don't reassert with SQS frequently enough,
-                # it will assume we died, and put our tasks back
-                # in the queue.  "frequently enough" means within
-                # visibility_timeout.)
-                count = 0
-                while True:
-                    reassert = (count >= visibility_timeout_reassert)
-                    for i, task in enumerate((local.task_active, local.task_push)):
-                        if task:
-                            name = task_names[i]
-                            if task.proc is not None:
-                                # test if process has finished
-                                task.retcode = task.proc.poll()
-                                if task.retcode is not None:
-                                    # process has finished
-                                    task.proc = None
-
-                                    # did process finish with errors?
-                                    if task.retcode != 0:
-                                        errtxt = "fatal error in %s task" % (name,)
-                                        if name == 'active':
-                                            raise error.ValueErrorRetry(errtxt)
-                                        else:
-                                            raise ValueError(errtxt)
-
-                                    # Process finished successfully.  If S3-push process,
-                                    # tell SQS that the task completed successfully.
-                                    if name == 'push':
-                                        print "******* TASK", task.id, "COMMITTED to S3"
-                                        q.delete_message(task.msg)
-                                        task.msg = None
-                                        local.task_count += 1
-                                        task_complete_accounting(local.task_count)
-
-                                    # active task completed?
-                                    if name == 'active':
-                                        print "******* TASK", task.id, "READY-FOR-PUSH"
-
-                            # tell SQS that we are still working on the task
-                            if reassert and task.proc is not None:
-                                print "******* REASSERT", name, task.id
-                                task.msg.change_visibility(visibility_timeout)
-
-                    # break out of loop only when no pending tasks remain
-                    if ((not local.task_active or local.task_active.proc is None)
-                        and (not local.task_push or local.task_push.proc is None)):
+                local.leases.heartbeat()
+
+                # poll active tasks for completion
+                if budget:
+                    budget.sample(rendering_tasks())
+                for slot in local.slots:
+                    poll_active(slot)
+
+                    # Queue the just-completed active task for push, freeing
+                    # its slot, unless the upload queue is full.
+                    if (slot.active and slot.active.proc is None
+                        and len(local.uploads) < upload_queue_depth):
+                        local.uploads.append(slot.active)
+                        slot.active = None
+
+                # poll S3-push tasks for completion
+                local.uploads = [task for task in local.uploads if task.proc is None or not poll_push(task)]
+
+                # Start concurrent push tasks to commit files generated by
+                # completed active tasks (such as blender render frames) to S3.
+                # If a task's output has been streamed to S3 while it rendered,
+                # its streaming process becomes the push task.
+                n_pushing = len([task for task in local.uploads if task.proc is not None])
+                for task in local.uploads:
+                    if task.proc is None:
+                        if task.watcher is not None:
+                            task.proc = task.watcher
+                            task.watcher = None
+                        elif n_pushing < push_workers:
+                            task.proc = start_s3_push_process(opts, args, conf, task.outdir, task_is_retry(task.msg))
+                            n_pushing += 1
+
+                # Keep a message leased for each slot without an active task,
+                # plus prefetch_tasks more.  If the queue is empty, don't read
+                # it again for a while unless we are idle.  Only an idle node
+                # long-polls, since tasks must be polled while busy.
+                idle = not (busy() or local.pending)
+                if time.time() >= next_read or idle:
+                    free = len([slot for slot in local.slots if slot.active is None])
+                    want = free + prefetch_tasks - len(local.pending)
+                    queue_empty = (want > 0 and not prefetch(q, want, receive_wait if idle else 0))
+                    if queue_empty:
+                        next_read = time.time() + 15
+
+                # start pending tasks on each slot without an active task
+                for slot in local.slots:
+                    if not local.pending:
                         break
-
-                    # setup for next process poll iteration
-                    if reassert:
-                        count = 0
-                    time.sleep(1)
-                    count += 1
-
-                # clean up the S3-push task
-                cleanup(local.task_push, 'push')
-                local.task_push = None
-
-                # start a concurrent push task to commit files generated by
-                # just-completed active task (such as blender render frames) to S3
-                if local.task_active:
-                    local.task_active.proc = start_s3_push_process(opts, args, conf, local.task_active.outdir)
-                    local.task_push = local.task_active
-                    local.task_active = None
-
-                # if no active task and no S3-push task, we are done (unless DONE is set to "poll")
-                if not local.task_active and not local.task_push:
-                    if read_done_file() == "poll":
-                        print "Polling for more work..."
-                        time.sleep(15)
-                    else:
+                    if slot.active is not None or slot.resume > time.time():
+                        continue
+                    if budget and not budget.admit(rendering_tasks(), pending_job()):
+                        break
+                    if disk_full():
                         break
+                    start_task(local.pending.popleft(), slot)
+
+                # if no active task and no S3-push task, and the queue
+                # is empty, we are done (unless DONE is set to "poll")
+                if not busy() and not local.pending:
+                    if queue_empty:
+                        if read_done_file() == "poll":
+                            print "Polling for more work..."
+                            if not receive_wait:
+                                time.sleep(15)
+                        else:
+                            break
+                    continue
+
+                # setup for next process poll iteration
+                time.sleep(1)
 
         finally:
+            if local.leases:
+                local.leases.stop()
             cleanup_all()
 
-    # initialize task_active and task_push states
-    task_names = ('active', 'push')
+    # initialize render slot and upload queue states
     local = State()
-    local.task_active = None
-    local.task_push = None
+    local.slots = []
+    local.uploads = []
+    local.disk_full = False
+    local.pending = collections.deque()
+    local.leases = None
     local.task_id_counter = 0
     local.task_count = 0
+    local.job_templates = {}
 
     # setup signal handler
     signal.signal(signal.SIGINT, signal_handler)
@@ -297,6 +1091,25 @@ def run_tasks(opts, args, conf):
     work_dir = aws.get_work_dir(conf)
     visibility_timeout_reassert = int(conf.get('VISIBILITY_TIMEOUT_REASSERT', '30'))
     visibility_timeout = int(conf.get('VISIBILITY_TIMEOUT', '120'))
+    max_task_failures = int(conf.get('MAX_TASK_FAILURES', '5'))
+    n_retries = int(conf.get('N_RETRIES', '5'))
+    error_pause = int(conf.get('ERROR_PAUSE', '30'))
+    render_slots = max(int(conf.get('RENDER_SLOTS', '1')), 1)
+    render_threads = int(conf.get('RENDER_THREADS', '0'))
+    if not render_threads and render_slots > 1:
+        render_threads = max(multiprocessing.cpu_count() // render_slots, 1)
+    stderr_tail_lines = int(conf.get('STDERR_TAIL_LINES', '50'))
+    prefetch_tasks = int(conf.get('PREFETCH_TASKS', '1'))
+    receive_wait = min(int(conf.get('RECEIVE_WAIT', '20')), 20)
+    stream_upload = int(conf.get('STREAM_UPLOAD', '0')) and not int(conf.get('SHARD_OUTPUT', '0'))
+    upload_queue_depth = max(int(conf.get('UPLOAD_QUEUE_DEPTH', '4')), 1)
+    push_workers = max(int(conf.get('PUSH_WORKERS', '2')), 1)
+    disk_high_water = int(conf.get('DISK_HIGH_WATER', '90'))
+
+    # with multiple render slots, start concurrent tasks only when they fit in memory
+    budget = None
+    if render_slots > 1 and int(conf.get('MEMORY_ADMISSION', '1')):
+        budget = MemoryBudget(conf)
 
     # validate RENDER_OUTPUT bucket
     aws.get_s3_output_bucket(conf)
@@ -336,6 +1149,14 @@ def run_tasks(opts, args, conf):
     # mount additional EBS volumes
     aws.mount_additional_ebs(conf, proj_dir)
 
+    # With multiple render slots, each slot runs its tasks in its own
+    # mirror of the project directory, so that files written by task
+    # scripts (such as subframe.py) don't collide.
+    if render_slots > 1:
+        slot_proj_dirs = [make_slot_project_dir(work_dir, proj_dir, i) for i in xrange(render_slots)]
+    else:
+        slot_proj_dirs = [proj_dir]
+
     # continue only if we are not in "dry-run" mode
     if not opts.dry_run:
         # execute the task loop
@@ -355,6 +1176,19 @@ def run_tasks(opts, args, conf):
 
         print "******* DONE (%d tasks completed)" % (local.task_count,)
 
+def make_slot_project_dir(work_dir, proj_dir, index):
+    """
+    Create a directory for render slot index that mirrors proj_dir
+    using symlinks to its top-level entries.  Relative paths
+    in .blend files resolve the same way as in proj_dir.
+    """
+    slot_dir = os.path.join(work_dir, "brenda-slot%d.tmp" % (index,))
+    utils.rmtree(slot_dir)
+    utils.mkdir(slot_dir)
+    for fn in os.listdir(proj_dir):
+        os.symlink(os.path.join(proj_dir, fn), os.path.join(slot_dir, fn))
+    return slot_dir
+
 def get_s3_project(conf, s3url, proj_dir):
     # target file in which to save S3 download
     fn = os.path.basename(s3url)
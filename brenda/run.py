@@ -263,14 +263,37 @@ cd "$B"
         "CURL_DEBUG",
         "VISIBILITY_TIMEOUT",
         "VISIBILITY_TIMEOUT_REASSERT",
+        "LEASE_STALL_TIMEOUT",
+        "SQS_ACK_DELAY",
         "N_RETRIES",
         "ERROR_PAUSE",
         "RESET_PERIOD",
         "BLENDER_PROJECT_ALWAYS_REFETCH",
+        "JOB_STORE",
+        "MAX_TASK_FAILURES",
+        "DEAD_LETTER_QUEUE",
+        "STDERR_TAIL_LINES",
+        "RENDER_SLOTS",
+        "RENDER_THREADS",
+        "MEMORY_ADMISSION",
+        "MEMORY_RESERVE",
+        "TASK_MEMORY",
+        "PREFETCH_TASKS",
+        "RECEIVE_WAIT",
+        "S3_UPLOAD_THREADS",
+        "S3_MULTIPART_THRESHOLD",
+        "S3_MULTIPART_CHUNK_SIZE",
+        "S3_SKIP_IDENTICAL",
+        "STREAM_UPLOAD",
+        "SHARD_OUTPUT",
+        "SHARD_SIZE",
+        "UPLOAD_QUEUE_DEPTH",
+        "PUSH_WORKERS",
+        "DISK_HIGH_WATER",
         "WORK_DIR",
         "SHUTDOWN",
         "DONE"
-        ] + list(aws.additional_ebs_iterator(conf))
+        ] + list(aws.additional_ebs_iterator(conf)) + sorted(k for k in conf if k.startswith('TRANSCODE_'))
 
     script = head
     for k in keys:
@@ -0,0 +1,179 @@
+# Brenda -- Blender render tool for Amazon Web Services
+# Copyright (C) 2013 James Yonan <james@openvpn.net>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+# Output shards.  With SHARD_OUTPUT, brenda-node packs the output
+# files of a task into tar shards of up to SHARD_SIZE MB, and pushes
+# each shard with a JSON index under the SHARD_PREFIX prefix of
+# RENDER_OUTPUT, rather than one PUT per file.  The index maps each
+# file name to the offset and size of its data in the shard, so that
+# single files can be fetched with ranged GETs.  Shards are packed
+# deterministically (sorted names, fixed metadata), so a retried task
+# with identical output produces identical shards.  brenda-work fetch
+# restores the files.
+
+import os, json, tarfile, fnmatch, threading, Queue
+import boto.s3.key
+from brenda import aws, error
+
+SHARD_PREFIX = 'brenda-shards/'
+
+def shard_groups(files, max_bytes):
+    """
+    Split files, a list of (path, name) tuples sorted by
+    name, into groups of at most max_bytes (0 for no limit).
+    """
+    group = []
+    size = 0
+    for path, name in files:
+        fsize = os.path.getsize(path)
+        if group and max_bytes and size + fsize > max_bytes:
+            yield group
+            group = []
+            size = 0
+        group.append((path, name))
+        size += fsize
+    if group:
+        yield group
+
+def pack(files, shard_dir, max_bytes=0):
+    """
+    Pack files, a list of (path, name) tuples, into tar shards and
+    JSON indexes in shard_dir.  Returns the (path, s3name) tuples
+    to upload.  Each shard is named after its first file.
+    """
+    ret = []
+    if not os.path.isdir(shard_dir):
+        os.makedirs(shard_dir)
+    for group in shard_groups(sorted(files, key=lambda f : f[1]), max_bytes):
+        base = group[0][1]
+        tar_fn = os.path.join(shard_dir, base + '.tar')
+        index = { 'shard' : base + '.tar', 'files' : {} }
+        tar = tarfile.open(tar_fn, 'w', format=tarfile.GNU_FORMAT)
+        try:
+            for path, name in group:
+                ti = tar.gettarinfo(path, name)
+                ti.mtime = 0
+                ti.uid = ti.gid = 0
+                ti.uname = ti.gname = ''
+                ti.mode = 0644
+                header = ti.tobuf(tar.format, tar.encoding, tar.errors)
+                index['files'][name] = [tar.offset + len(header), ti.size]
+                with open(path, 'rb') as f:
+                    tar.addfile(ti, f)
+        finally:
+            tar.close()
+        index_fn = os.path.join(shard_dir, base + '.json')
+        with open(index_fn, 'w') as f:
+            json.dump(index, f, sort_keys=True)
+        print "SHARD", tar_fn, "(%d files)" % (len(group),)
+        ret.append((tar_fn, SHARD_PREFIX + base + '.tar'))
+        ret.append((index_fn, SHARD_PREFIX + base + '.json'))
+    return ret
+
+def iter_indexes(conf):
+    """
+    Generate (index, bucktup) for each shard index in RENDER_OUTPUT.
+    A job has an index per shard, so they are fetched on a pool of
+    SHARD_FETCH_THREADS threads, and generated in no particular order.
+    """
+    def worker():
+        # boto connections are not thread-safe, so each
+        # thread uses its own connection
+        buck = None
+        while True:
+            name = names.get()
+            if name is None:
+                break
+            try:
+                if buck is None:
+                    buck = error.retry(conf, lambda : aws.get_s3_output_bucket(conf))[0]
+                k = boto.s3.key.Key(buck)
+                k.key = name
+                results.put(json.loads(error.retry(conf, k.get_contents_as_string)))
+            except Exception, e:
+                results.put(e)
+
+    bucktup = aws.get_s3_output_bucket(conf)
+    prefix = bucktup[1][1] + SHARD_PREFIX
+    keys = [k.name for k in bucktup[0].list(prefix=prefix) if k.name.endswith('.json')]
+    if not keys:
+        return
+
+    names = Queue.Queue()
+    results = Queue.Queue()
+    for name in keys:
+        names.put(name)
+    for i in xrange(min(max(int(conf.get('SHARD_FETCH_THREADS', '16')), 1), len(keys))):
+        names.put(None)
+        t = threading.Thread(target=worker)
+        t.daemon = True
+        t.start()
+    for name in keys:
+        index = results.get()
+        if isinstance(index, Exception):
+            raise index
+        yield index, bucktup
+
+def list_shard_members(conf):
+    """
+    Return the names of all files packed into shards.
+    """
+    names = []
+    for index, bucktup in iter_indexes(conf):
+        names.extend(index['files'].keys())
+    return names
+
+def fetch(conf, dest, patterns=None):
+    """
+    Restore files packed into shards into directory dest.  If
+    patterns (shell wildcards) are given, only files that match
+    one of them are fetched, using ranged GETs.
+    """
+    if not os.path.isdir(dest):
+        os.makedirs(dest)
+    n_files = 0
+    for index, bucktup in iter_indexes(conf):
+        k = bucktup[0].get_key(bucktup[1][1] + SHARD_PREFIX + index['shard'])
+        if k is None:
+            print "Shard %s is missing" % (index['shard'],)
+            continue
+        names = sorted(index['files'].keys())
+        if patterns:
+            names = [n for n in names if [p for p in patterns if fnmatch.fnmatch(n, p)]]
+            for name in names:
+                offset, size = index['files'][name]
+                data = ''
+                if size:
+                    data = error.retry(conf, lambda : k.get_contents_as_string(
+                        headers={'Range' : 'bytes=%d-%d' % (offset, offset+size-1)}))
+                with open(os.path.join(dest, name), 'wb') as f:
+                    f.write(data)
+                print "FETCH", name, "FROM", index['shard']
+        else:
+            def get_shard():
+                tar = tarfile.open(fileobj=k, mode='r|')
+                try:
+                    for ti in tar:
+                        if ti.name in index['files']:
+                            tar.extract(ti, dest)
+                            os.utime(os.path.join(dest, ti.name), None)
+                finally:
+                    tar.close()
+                    k.close()
+            error.retry(conf, get_shard)
+            print "FETCH %d files FROM %s" % (len(names), index['shard'])
+        n_files += len(names)
+    print "Fetched %d files into %s" % (n_files, dest)
@@ -0,0 +1,175 @@
+# Brenda -- Blender render tool for Amazon Web Services
+# Copyright (C) 2013 James Yonan <james@openvpn.net>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+# Transcode stage between render and push.  A TRANSCODE_<EXT> config
+# var gives a shell command that re-encodes output files with extension
+# .<ext>, with {in} and {out} replaced by the input and output paths,
+# for example:
+#
+#   TRANSCODE_PNG="optipng -quiet -o2 -out {out} {in}"
+#   TRANSCODE_EXR="zstd -q -19 -o {out} {in}"
+#   TRANSCODE_EXR_SUFFIX=.zst
+#
+# The transcoded file is pushed under the same name, plus the optional
+# TRANSCODE_<EXT>_SUFFIX.  Commands run on a pool of TRANSCODE_THREADS
+# threads.  If a command fails, or (without a suffix) doesn't make the
+# file smaller, the original file is pushed instead.
+
+import os, time, threading, Queue, subprocess, pipes, multiprocessing
+
+TRANSCODE_DIR = '.brenda-transcode'
+
+def transcode_suffixes(conf):
+    """
+    Return the list of TRANSCODE_<EXT>_SUFFIX values in conf.
+    """
+    return [v for k, v in conf.items() if k.startswith('TRANSCODE_') and k.endswith('_SUFFIX') and v]
+
+class Transcoder(object):
+    """
+    Transcodes files submit()ted to it on a pool of threads.
+    Completed files are returned by results() and finish().
+    """
+
+    def __init__(self, conf, outdir):
+        self.conf = conf
+        self.codecs = {}
+        for k, v in conf.items():
+            if k.startswith('TRANSCODE_') and not k.endswith('_SUFFIX') and k != 'TRANSCODE_THREADS' and v:
+                ext = k[len('TRANSCODE_'):].lower()
+                self.codecs[ext] = (v, conf.get(k + '_SUFFIX', ''))
+        self.n_threads = max(int(conf.get('TRANSCODE_THREADS', str(multiprocessing.cpu_count()))), 1)
+        self.tmpdir = os.path.join(outdir, TRANSCODE_DIR)
+        self.q = Queue.Queue()
+        self.done = Queue.Queue()
+        self.lock = threading.Lock()
+        self.threads = []
+        self.n_pending = 0
+        self.stats = {}
+
+    def codec(self, name):
+        """
+        Return the (command, suffix) tuple for file name,
+        or None if it isn't transcoded.
+        """
+        return self.codecs.get(os.path.splitext(name)[1][1:].lower())
+
+    def transcode(self, files):
+        """
+        Transcode files, a list of (path, s3name) tuples, and
+        return the (path, s3name) tuples to push.
+        """
+        ret = []
+        for path, s3name in files:
+            if self.codec(s3name):
+                self.submit(path, s3name)
+            else:
+                ret.append((path, s3name))
+        return ret + self.finish()
+
+    def submit(self, path, s3name):
+        """
+        Queue file path, to be pushed as s3name, for transcoding.
+        """
+        with self.lock:
+            self.n_pending += 1
+        self.q.put((path, s3name))
+        if len(self.threads) < self.n_threads:
+            t = threading.Thread(target=self.worker)
+            t.daemon = True
+            t.start()
+            self.threads.append(t)
+
+    def results(self):
+        """
+        Return the (path, s3name) tuples of files transcoded
+        since the last call, without waiting.
+        """
+        ret = []
+        while True:
+            try:
+                ret.append(self.done.get_nowait())
+            except Queue.Empty:
+                return ret
+            with self.lock:
+                self.n_pending -= 1
+
+    def finish(self):
+        """
+        Wait for all submitted files, print a size/time report,
+        and return the remaining (path, s3name) tuples.
+        """
+        ret = []
+        while self.n_pending:
+            ret.append(self.done.get())
+            with self.lock:
+                self.n_pending -= 1
+        for t in self.threads:
+            self.q.put(None)
+        for t in self.threads:
+            t.join()
+        self.threads = []
+        self.report()
+        return ret
+
+    def report(self):
+        for ext, (n, n_in, n_out, elapsed) in sorted(self.stats.items()):
+            print "TRANSCODED %d .%s files, %.1f MB -> %.1f MB (%.0f%%) in %.1f seconds" % (
+                n, ext, float(n_in) / (1024*1024), float(n_out) / (1024*1024),
+                100.0 * n_out / max(n_in, 1), elapsed)
+        self.stats = {}
+
+    def worker(self):
+        while True:
+            item = self.q.get()
+            if item is None:
+                break
+            path, s3name = item
+            try:
+                item = self.transcode_file(path, s3name)
+            except Exception, e:
+                print "******* TRANSCODE EXCEPTION", path, e
+            self.done.put(item)
+
+    def transcode_file(self, path, s3name):
+        command, suffix = self.codec(s3name)
+        if not os.path.isdir(self.tmpdir):
+            try:
+                os.makedirs(self.tmpdir)
+            except OSError:
+                if not os.path.isdir(self.tmpdir):
+                    raise
+        out = os.path.join(self.tmpdir, s3name + suffix)
+        cmd = command.replace('{in}', pipes.quote(path)).replace('{out}', pipes.quote(out))
+
+        start = time.time()
+        ret = subprocess.call(cmd, shell=True)
+        elapsed = time.time() - start
+        if ret != 0 or not os.path.isfile(out):
+            print "******* TRANSCODE FAILED (%d), pushing original:" % (ret,), cmd
+            return path, s3name
+
+        size_in = os.path.getsize(path)
+        size_out = os.path.getsize(out)
+        if not suffix and size_out >= size_in:
+            print "TRANSCODE", s3name, "not smaller, pushing original"
+            size_out = size_in
+            out = path
+        ext = os.path.splitext(s3name)[1][1:].lower()
+        with self.lock:
+            n, n_in, n_out, t = self.stats.get(ext, (0, 0, 0, 0.0))
+            self.stats[ext] = (n + 1, n_in + size_in, n_out + size_out, t + elapsed)
+        return out, s3name + suffix
@@ -0,0 +1,321 @@
+# Brenda -- Blender render tool for Amazon Web Services
+# Copyright (C) 2013 James Yonan <james@openvpn.net>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+# Parallel upload of render output to the RENDER_OUTPUT bucket.
+# Files are uploaded on a pool of S3_UPLOAD_THREADS threads, each
+# with its own S3 connection, since boto connections are not
+# thread-safe.  Files of at least S3_MULTIPART_THRESHOLD MB are sent
+# as multipart uploads, and their parts of S3_MULTIPART_CHUNK_SIZE MB
+# are spread over the same pool.  Each file or part is retried on its
+# own, so a transient error doesn't resend the whole push.
+#
+# With S3_SKIP_IDENTICAL, the output of a retried task (one whose
+# message was received before) is checked before upload: the MD5 of
+# each file is compared with the ETag of the existing object (from a
+# HEAD request), so that byte-identical output isn't uploaded again.
+# First attempts skip the check, since their output can't exist yet.
+# Objects uploaded in parts have an ETag that is the MD5 of the
+# MD5s of their parts, with a -N suffix, so those are compared
+# with the ETag the file would get with our part size.
+#
+# On Linux, a task's output directory can also be watched with
+# inotify, so that each file is uploaded as soon as it is closed
+# (see brenda-node STREAM_UPLOAD).
+
+import os, time, threading, Queue, select, struct, ctypes, ctypes.util, hashlib, base64
+import boto.s3.multipart, boto.exception
+from brenda import aws, error
+
+MB = 1024 * 1024
+
+# S3 limits on multipart uploads
+MIN_PART_SIZE = 5 * MB
+MAX_PARTS = 10000
+
+class State(object):
+    pass
+
+def file_md5(path, part_size=None):
+    """
+    Read file path once, and return its MD5 as a (hex, base64)
+    tuple, along with the ETag that S3 gives it when uploaded
+    in parts of part_size bytes (None if part_size is None).
+    """
+    md5 = hashlib.md5()
+    part_digests = []
+    with open(path, 'rb') as f:
+        while True:
+            data = f.read(part_size or MB)
+            if not data:
+                break
+            md5.update(data)
+            if part_size:
+                part_digests.append(hashlib.md5(data).digest())
+    etag = None
+    if part_size:
+        etag = "%s-%d" % (hashlib.md5(''.join(part_digests)).hexdigest(), len(part_digests))
+    return (md5.hexdigest(), base64.b64encode(md5.digest())), etag
+
+class Uploader(object):
+    """
+    Uploads files put() to it on a pool of threads, until finish().
+    retry should be True for the output of a retried task, so that
+    files already in S3 can be skipped.  If pushed_log is given, the
+    name of each object is appended to that file before it is
+    written, so that the objects can be deleted if the task fails.
+    """
+
+    def __init__(self, conf, retry=False, pushed_log=None):
+        self.conf = conf
+        self.n_threads = max(int(conf.get('S3_UPLOAD_THREADS', '8')), 1)
+        self.threshold = int(conf.get('S3_MULTIPART_THRESHOLD', '64')) * MB
+        self.part_size = max(int(conf.get('S3_MULTIPART_CHUNK_SIZE', '16')) * MB, MIN_PART_SIZE)
+        self.skip_identical = retry and int(conf.get('S3_SKIP_IDENTICAL', '1'))
+        self.q = Queue.Queue()
+        self.lock = threading.Lock()
+        self.threads = []
+        self.errors = []
+        self.uploads = []
+        self.bucktup = None
+        self.pushed_log = pushed_log
+        self.n_files = 0
+        self.n_bytes = 0
+        self.n_skipped = 0
+        self.skipped_bytes = 0
+        self.start = time.time()
+
+    def upload(self, files):
+        """
+        Upload files, a list of (path, s3name) tuples, and
+        return the number of bytes uploaded.
+        """
+        # queue the largest files first, so that they don't
+        # finish last on a single thread
+        for size, path, s3name in sorted([(os.path.getsize(path), path, s3name) for path, s3name in files], reverse=True):
+            self.put(path, s3name, size)
+        return self.finish()
+
+    def put(self, path, s3name, size=None):
+        """
+        Queue file path for upload as s3name.
+        """
+        if size is None:
+            size = os.path.getsize(path)
+        self.n_files += 1
+        if size >= self.threshold and size > self.part_size:
+            if self.bucktup is None:
+                self.bucktup = error.retry(self.conf, lambda : aws.get_s3_output_bucket(self.conf))
+            if self.skip_identical:
+                md5, etag = file_md5(path, self.multipart_part_size(size))
+                if self.identical(self.bucktup, s3name, (md5[0], etag), size):
+                    return
+            upload = self.start_multipart(self.bucktup, path, s3name, size)
+            self.uploads.append(upload)
+            for part_num, offset, part_size in upload.parts:
+                self.q.put(self.put_part(upload, part_num, offset, part_size))
+        else:
+            self.q.put(self.put_file(path, s3name, size))
+
+        # start threads for the backlog, e.g. the parts of a large file
+        n_threads = min(self.n_threads, self.q.qsize())
+        while len(self.threads) < n_threads:
+            t = threading.Thread(target=self.worker)
+            t.daemon = True
+            t.start()
+            self.threads.append(t)
+
+    def finish(self):
+        """
+        Wait for all queued uploads, and return the number of
+        bytes uploaded.  Raises the first upload error, if any.
+        """
+        for t in self.threads:
+            self.q.put(None)
+        for t in self.threads:
+            t.join()
+        self.threads = []
+
+        if self.errors:
+            for upload in self.uploads:
+                if not upload.complete:
+                    self.abort_multipart(upload)
+            raise self.errors[0]
+
+        elapsed = time.time() - self.start
+        if self.n_skipped:
+            print "SKIPPED %d identical files, %.1f MB not uploaded" % (
+                self.n_skipped, float(self.skipped_bytes) / MB)
+        if self.n_files:
+            print "PUSHED %d files, %.1f MB in %.1f seconds (%.1f MB/s)" % (
+                self.n_files, float(self.n_bytes) / MB, elapsed, float(self.n_bytes) / MB / max(elapsed, 0.001))
+        return self.n_bytes
+
+    def worker(self):
+        bucktup = None
+        while True:
+            item = self.q.get()
+            try:
+                if item is None:
+                    break
+                if not self.errors:
+                    if bucktup is None:
+                        bucktup = error.retry(self.conf, lambda : aws.get_s3_output_bucket(self.conf))
+                    item(bucktup)
+            except Exception, e:
+                with self.lock:
+                    self.errors.append(e)
+            finally:
+                self.q.task_done()
+
+    def identical(self, bucktup, s3name, etags, size):
+        """
+        Return True if s3name already exists with one of etags,
+        and count it as skipped.
+        """
+        def get_etag():
+            try:
+                k = bucktup[0].get_key(bucktup[1][1] + s3name)
+            except boto.exception.S3ResponseError, e:
+                print "HEAD failed on", s3name, e
+                return None
+            if k is not None:
+                return k.etag.strip('"')
+
+        etag = error.retry(self.conf, get_etag)
+        if etag is None or etag not in etags:
+            return False
+        print "SKIP", s3name, "(identical to", aws.format_s3_url(bucktup, s3name) + ")"
+        with self.lock:
+            self.n_files -= 1
+            self.n_skipped += 1
+            self.skipped_bytes += size
+        return True
+
+    def put_file(self, path, s3name, size):
+        def item(bucktup):
+            md5 = None
+            if self.skip_identical:
+                md5 = file_md5(path)[0]
+                if self.identical(bucktup, s3name, (md5[0],), size):
+                    return
+            print "PUSH", path, "TO", aws.format_s3_url(bucktup, s3name)
+            self.log_pushed(s3name)
+            error.retry(self.conf, lambda : aws.put_s3_file(bucktup, path, s3name, md5=md5))
+            with self.lock:
+                self.n_bytes += size
+        return item
+
+    def put_part(self, upload, part_num, offset, size):
+        def item(bucktup):
+            mp = boto.s3.multipart.MultiPartUpload(bucktup[0])
+            mp.key_name = upload.mp.key_name
+            mp.id = upload.mp.id
+
+            def action():
+                with open(upload.path, 'rb') as f:
+                    f.seek(offset)
+                    mp.upload_part_from_file(f, part_num, size=size)
+
+            error.retry(self.conf, action)
+            with self.lock:
+                self.n_bytes += size
+                upload.remaining -= 1
+                last = (upload.remaining == 0)
+            if last:
+                self.log_pushed(upload.s3name)
+                error.retry(self.conf, mp.complete_upload)
+                upload.complete = True
+                print "PUSH", upload.path, "TO", aws.format_s3_url(bucktup, upload.s3name), "(%d parts)" % (upload.n_parts,)
+        return item
+
+    def log_pushed(self, s3name):
+        if self.pushed_log:
+            with self.lock:
+                with open(self.pushed_log, 'a') as f:
+                    f.write(s3name + '\n')
+
+    def multipart_part_size(self, size):
+        return max(self.part_size, (size + MAX_PARTS - 1) // MAX_PARTS)
+
+    def start_multipart(self, bucktup, path, s3name, size):
+        part_size = self.multipart_part_size(size)
+        upload = State()
+        upload.path = path
+        upload.s3name = s3name
+        upload.parts = [(i + 1, offset, min(part_size, size - offset))
+                        for i, offset in enumerate(xrange(0, size, part_size))]
+        upload.n_parts = upload.remaining = len(upload.parts)
+        upload.complete = False
+
+        upload.mp = error.retry(self.conf, lambda : bucktup[0].initiate_multipart_upload(
+            bucktup[1][1] + s3name, reduced_redundancy=True))
+        return upload
+
+    def abort_multipart(self, upload):
+        try:
+            print "PUSH ABORT", upload.path
+            upload.mp.cancel_upload()
+        except Exception, e:
+            print "******* PUSH ABORT EXCEPTION", upload.path, e
+
+class Inotify(object):
+    """
+    Minimal ctypes binding of Linux inotify.  Raises OSError
+    if inotify is not available.
+    """
+
+    IN_CLOSE_WRITE = 0x00000008
+    IN_MOVED_TO = 0x00000080
+    IN_CLOEXEC = 0x00080000
+
+    EVENT = struct.Struct('iIII') # wd, mask, cookie, len
+
+    def __init__(self):
+        try:
+            libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+            self.add_watch_fn = libc.inotify_add_watch
+            self.fd = libc.inotify_init1(self.IN_CLOEXEC)
+        except AttributeError:
+            raise OSError("inotify not available")
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), "inotify_init1 failed")
+
+    def add_watch(self, path, mask):
+        wd = self.add_watch_fn(self.fd, path, mask)
+        if wd < 0:
+            raise OSError(ctypes.get_errno(), "inotify_add_watch failed on %r" % (path,))
+        return wd
+
+    def read(self, timeout):
+        """
+        Wait up to timeout seconds for events, and return
+        the names of the files they refer to.
+        """
+        names = []
+        if select.select([self.fd], [], [], timeout)[0]:
+            data = os.read(self.fd, 65536)
+            i = 0
+            while i + self.EVENT.size <= len(data):
+                wd, mask, cookie, length = self.EVENT.unpack_from(data, i)
+                i += self.EVENT.size
+                name = data[i:i+length].rstrip('\0')
+                i += length
+                if name:
+                    names.append(name)
+        return names
+
+    def close(self):
+        os.close(self.fd)
@@ -14,14 +14,56 @@
 # You should have received a copy of the GNU General Public License
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
-import random
-from brenda import aws
+import os, re, random, threading, time, hashlib, json, Queue
+from brenda import aws, error, utils, job, shard, transcode
+
+# default size of the buffer used to stream-shuffle tasks (--randomize)
+SHUFFLE_BUFFER = 10000
+
+class TaskTemplate(object):
+    """
+    A task script, compiled once into alternating runs of literal
+    text and macro names, so that expanding it for each task is a
+    single join rather than a chain of str.replace calls.  Macros
+    without a value (such as $OUTDIR, which is expanded by
+    brenda-node) are left in place.
+    """
+
+    MACROS = ('$FRAME', '$START', '$END', '$STEP',
+              '$SF_MIN_X', '$SF_MAX_X', '$SF_MIN_Y', '$SF_MAX_Y',
+              '$SPLIT_INDEX', '$SPLIT_COUNT', '$SEED', '$SAMPLES')
+
+    def __init__(self, script, macros=MACROS):
+        names = sorted(macros, key=len, reverse=True)
+        re_macro = re.compile("(%s)" % ('|'.join([re.escape(n) for n in names]),))
+        self._parts = re_macro.split(script)
+
+    def macros(self):
+        """
+        Return the set of macros referenced by the template.
+        """
+        return frozenset(self._parts[1::2])
+
+    def expand(self, macros):
+        parts = self._parts[:]
+        for i in xrange(1, len(parts), 2):
+            parts[i] = macros.get(parts[i], parts[i])
+        return ''.join(parts)
 
 def subframe_iterator_defined(opts):
-    return opts.subdiv_x > 0 and opts.subdiv_y > 0
+    return getattr(opts, 'subdiv_x', 0) > 0 and getattr(opts, 'subdiv_y', 0) > 0
 
 def subframe_iterator(opts):
-    if subframe_iterator_defined(opts):
+    if subframe_iterator_defined(opts) and getattr(opts, 'tile_cost_map', None):
+        cost_map = load_tile_cost_map(opts.tile_cost_map)
+        for min_x, max_x, min_y, max_y in kd_tile_iterator(cost_map, opts.subdiv_x * opts.subdiv_y):
+            yield (
+                ('$SF_MIN_X', str(min_x)),
+                ('$SF_MAX_X', str(max_x)),
+                ('$SF_MIN_Y', str(min_y)),
+                ('$SF_MAX_Y', str(max_y)),
+                )
+    elif subframe_iterator_defined(opts):
         xfrac = 1.0 / opts.subdiv_x
         yfrac = 1.0 / opts.subdiv_y
         for x in xrange(opts.subdiv_x):
@@ -37,58 +79,779 @@ def subframe_iterator(opts):
                     ('$SF_MAX_Y', str(max_y)),
                     )
 
+def load_tile_cost_map(fn):
+    """
+    Read a render cost map from fn, a text file containing a grid
+    of whitespace-separated numbers, one row per line, with the
+    first line being the top of the frame.  The grid may be of any
+    resolution, e.g. per-pixel-block timings from a low-res preview
+    render, or the timings of a previous uniform -X/-Y tile render.
+    Returns the grid as a list of rows, bottom row first, to match
+    Blender's border coordinates.
+    """
+    rows = []
+    with open(fn) as f:
+        for line in f.readlines():
+            line = line.strip()
+            if line and not line.startswith('#'):
+                rows.append([float(v) for v in line.split()])
+    if not rows or [r for r in rows if len(r) != len(rows[0])]:
+        raise ValueError("%s: tile cost map must be a non-empty rectangular grid" % (fn,))
+
+    # give zero-cost cells a tiny cost so that regions of zero
+    # total cost are split by area instead of degenerating
+    floor = max([max(r) for r in rows]) * 1e-6 or 1.0
+    rows.reverse()
+    return [[max(v, floor) for v in r] for r in rows]
+
+def kd_tile_iterator(cost_map, n_tiles):
+    """
+    Split the unit frame into n_tiles rectangles of roughly equal
+    render cost, according to cost_map (see load_tile_cost_map),
+    by recursive k-d bisection: each region is cut across its
+    longer side at the point dividing its cost in proportion to
+    the number of tiles on either side.  Cost is assumed to be
+    uniform within a cost map cell.  Yields (min_x, max_x, min_y,
+    max_y) tuples.
+    """
+    n_rows = len(cost_map)
+    n_cols = len(cost_map[0])
+
+    def overlap(lo, hi, i, n):
+        # fraction of cell i (of n) covered by [lo, hi]
+        return max(0.0, min(hi, float(i+1)/n) - max(lo, float(i)/n)) * n
+
+    def marginal(x0, x1, y0, y1, axis):
+        # cost of region summed over the other axis, per cell along axis
+        if axis == 0:
+            return [sum([cost_map[j][i] * overlap(y0, y1, j, n_rows) for j in xrange(n_rows)]) * overlap(x0, x1, i, n_cols)
+                    for i in xrange(n_cols)]
+        else:
+            return [sum([cost_map[j][i] * overlap(x0, x1, i, n_cols) for i in xrange(n_cols)]) * overlap(y0, y1, j, n_rows)
+                    for j in xrange(n_rows)]
+
+    def cut(lo, hi, costs, frac):
+        # position in [lo, hi] where the cumulative cost reaches frac of the total
+        n = len(costs)
+        target = sum(costs) * frac
+        acc = 0.0
+        for i, c in enumerate(costs):
+            if c > 0.0 and acc + c >= target:
+                clo = max(lo, float(i)/n)
+                chi = min(hi, float(i+1)/n)
+                pos = clo + (target - acc) / c * (chi - clo)
+                rpos = round(pos, 4)
+                if lo < rpos < hi:
+                    return rpos
+                return pos
+            acc += c
+        return hi
+
+    def split(x0, x1, y0, y1, n):
+        if n <= 1:
+            yield x0, x1, y0, y1
+            return
+        n1 = n // 2
+        frac = float(n1) / n
+        if x1 - x0 >= y1 - y0:
+            c = cut(x0, x1, marginal(x0, x1, y0, y1, 0), frac)
+            regions = ((x0, c, y0, y1, n1), (c, x1, y0, y1, n - n1))
+        else:
+            c = cut(y0, y1, marginal(x0, x1, y0, y1, 1), frac)
+            regions = ((x0, x1, y0, c, n1), (x0, x1, c, y1, n - n1))
+        for r in regions:
+            for tile in split(*r):
+                yield tile
+
+    return split(0.0, 1.0, 0.0, 1.0, n_tiles)
+
+def frame_range_iterator(opts):
+    """
+    Yield a (start, end, step) tuple for each task-sized
+    range of frames in the job.
+    """
+    if getattr(opts, 'target_task_time', None):
+        for r in adaptive_frame_range_iterator(opts):
+            yield r
+    else:
+        task_size = getattr(opts, 'task_size', 1)
+        for fnum in xrange(opts.start, opts.end+1, task_size):
+            yield fnum, min(fnum + task_size - 1, opts.end), 1
+
+def adaptive_frame_range_iterator(opts):
+    """
+    Group contiguous frames into variable-size tasks whose
+    estimated duration (opts.task_overhead for Blender startup,
+    scene load, etc., plus the per-frame costs) stays within
+    opts.target_task_time.  Cheap frames are batched together
+    to amortize the per-task overhead, while a frame that alone
+    exceeds the target gets a task of its own.
+    """
+    cost = get_frame_cost_function(opts)
+    target = opts.target_task_time
+    overhead = getattr(opts, 'task_overhead', 0.0) or 0.0
+    start = None
+    duration = 0.0
+    for fnum in xrange(opts.start, opts.end+1):
+        c = cost(fnum)
+        if start is not None and duration + c > target:
+            yield start, fnum - 1, 1
+            start = None
+        if start is None:
+            start = fnum
+            duration = overhead
+        duration += c
+    if start is not None:
+        yield start, opts.end, 1
+
+def load_frame_costs(fn):
+    """
+    Read per-frame render cost estimates from fn, a text file
+    with one "FRAME COST" pair per line, where COST is in any
+    consistent unit, such as seconds from a previous run's task
+    timings or from a quick low-sample pre-pass.  Blank lines and
+    lines starting with '#' are ignored.  Returns a dictionary
+    mapping frame number to cost.
+    """
+    costs = {}
+    with open(fn) as f:
+        for lnum, line in enumerate(f.readlines()):
+            line = line.strip()
+            if not line or line.startswith('#'):
+                continue
+            try:
+                frame, cost = line.split()
+                costs[int(frame)] = float(cost)
+            except ValueError:
+                raise ValueError("%s:%d: expected FRAME COST, got %r" % (fn, lnum+1, line))
+    if not costs:
+        raise ValueError("%s: no frame costs found" % (fn,))
+    return costs
+
+def frame_cost_function(costs):
+    """
+    Return a function mapping frame number to estimated cost,
+    using the mean cost for frames missing from costs.
+    """
+    mean = sum(costs.itervalues()) / len(costs)
+    return lambda frame : costs.get(frame, mean)
+
+def get_frame_cost_function(opts):
+    fn = getattr(opts, 'cost_file', None)
+    if not fn:
+        raise ValueError("--order=lpt and --target-task-time require per-frame cost estimates (--cost-file)")
+    return frame_cost_function(load_frame_costs(fn))
+
+def range_cost(cost, start, end, step):
+    return sum([cost(f) for f in xrange(start, end+1, step)])
+
+def stratified_key(i):
+    """
+    Sort key for coarse-to-fine ordering of index i: index 0, then
+    every 2**k'th index for the largest k, then the odd multiples of
+    2**(k-1), and so on down to the odd indices.
+    """
+    if i == 0:
+        return (-64, 0)
+    return (1 - (i & -i).bit_length(), i)
+
+ORDERS = ('frame', 'lpt', 'stratified')
+
+def order_frame_ranges(opts, ranges):
+    """
+    Order the (start, end, step) frame ranges of a job according
+    to opts.order:
+      frame      -- frame order (default).
+      lpt        -- longest processing time first, using per-frame
+                    cost estimates, so that the most expensive tasks
+                    don't end up in the tail of the job.
+      stratified -- coarse-to-fine (e.g. every 64th task, then every
+                    32nd, ...), so that an evenly spaced preview of
+                    the whole sequence is rendered first.
+    """
+    order = getattr(opts, 'order', None) or 'frame'
+    if order == 'frame':
+        return ranges
+    elif order == 'lpt':
+        cost = get_frame_cost_function(opts)
+        return sorted(ranges, key=lambda r : range_cost(cost, *r), reverse=True)
+    elif order == 'stratified':
+        return [r for i, r in sorted(enumerate(ranges), key=lambda ir : stratified_key(ir[0]))]
+    else:
+        raise ValueError("unknown task order %r, must be one of %r" % (order, ORDERS))
+
+def sample_split_iterator(opts):
+    """
+    Split each frame by samples rather than by area: yield the
+    macros of opts.sample_split tasks that each render the full
+    frame with a different seed ($SEED) and, if opts.samples gives
+    the total sample count, their share of the samples ($SAMPLES).
+    The partial renders are averaged into the final frame by a
+    merge step (see misc/merge.py).
+    """
+    n_split = getattr(opts, 'sample_split', 0) or 0
+    samples = getattr(opts, 'samples', None)
+    if n_split > 0 and samples and samples < n_split:
+        raise ValueError("--samples (%d) must be at least --sample-split (%d)" % (samples, n_split))
+    for i in xrange(n_split):
+        macros = (
+            ('$SPLIT_INDEX', str(i)),
+            ('$SPLIT_COUNT', str(n_split)),
+            ('$SEED', str(i)),
+            )
+        if samples:
+            macros += (('$SAMPLES', str(samples // n_split + (1 if i < samples % n_split else 0))),)
+        yield macros
+
+def task_variants(opts):
+    """
+    Return the list of per-task macro lists for each frame range:
+    one task per subframe tile and per sample split.
+    """
+    variants = list(subframe_iterator(opts)) or [()]
+    splits = list(sample_split_iterator(opts))
+    if splits:
+        variants = [v + sp for v in variants for sp in splits]
+    return variants
+
+def frame_range_macros(start, end, step):
+    return {
+        '$FRAME' : "-s %d -e %d -j %d" % (start, end, step),
+        '$START' : "%d" % (start,),
+        '$END' : "%d" % (end,),
+        '$STEP' : "%d" % (step,),
+        }
+
+def task_macro_iterator(opts):
+    """
+    Yield a dictionary of macro values for each task in the job.
+    """
+    variants = task_variants(opts)
+    for start, end, step in order_frame_ranges(opts, frame_range_iterator(opts)):
+        macros = frame_range_macros(start, end, step)
+        for macro_list in variants:
+            v_macros = macros.copy()
+            v_macros.update(macro_list)
+            yield v_macros
+
+def shuffle_iterator(seq, buffer_size=SHUFFLE_BUFFER):
+    """
+    Shuffle seq as it streams by, holding at most buffer_size
+    items in memory.  If seq fits in the buffer, the result is
+    a uniform random permutation, as with random.shuffle.
+    """
+    buf = []
+    for item in seq:
+        if len(buf) < buffer_size:
+            buf.append(item)
+        else:
+            i = random.randrange(buffer_size)
+            yield buf[i]
+            buf[i] = item
+    random.shuffle(buf)
+    for item in buf:
+        yield item
+
+def output_pattern(opts, task_script):
+    """
+    Return the render output naming pattern of a task script,
+    i.e. opts.output_pattern if given, otherwise the file name
+    following $OUTDIR/ in the task script.
+    """
+    pattern = getattr(opts, 'output_pattern', None)
+    if not pattern:
+        m = re.search(r"\$OUTDIR/([^\s'\"]+)", task_script)
+        if not m:
+            raise ValueError("cannot determine output naming pattern from task script, use --output-pattern")
+        pattern = m.group(1)
+    if '#' not in pattern:
+        # Blender appends a 4-digit frame number when there are no '#' characters
+        pattern += '####'
+    return pattern
+
+class OutputMatcher(object):
+    """
+    Tests whether all of the outputs of a task already exist in
+    RENDER_OUTPUT, given the output naming pattern of the task
+    script and the list of object names under RENDER_OUTPUT.
+    Object names are matched with and without their file extension,
+    since Blender appends one to the pattern.
+    """
+
+    re_hashes = re.compile(r"#+")
+
+    def __init__(self, pattern, names):
+        self.template = TaskTemplate(pattern)
+        self.names = set(names)
+        for name in names:
+            if '.' in name:
+                self.names.add(name.rsplit('.', 1)[0])
+
+    def task_done(self, macros):
+        name = self.template.expand(macros)
+        for fnum in xrange(int(macros['$START']), int(macros['$END'])+1, int(macros['$STEP'])):
+            fname = self.re_hashes.sub(lambda m : "%0*d" % (len(m.group(0)), fnum), name)
+            if fname not in self.names:
+                return False
+        return True
+
+def cache_file_name(conf, kind, resource):
+    """
+    Return the name of the local cache file of the given kind
+    for resource (such as an S3 or SQS URL), in CACHE_DIR.
+    """
+    cache_dir = conf.get('CACHE_DIR', os.path.join(os.path.expanduser("~"), ".brenda-cache"))
+    if not os.path.isdir(cache_dir):
+        utils.makedirs(cache_dir)
+    return os.path.join(cache_dir, "%s-%s" % (kind, hashlib.sha1(resource).hexdigest()))
+
+def get_render_output_names(conf, refresh=False):
+    """
+    List RENDER_OUTPUT and its output shards, caching each listing
+    locally for RESUME_CACHE_TTL seconds (default=600) so that
+    repeated resumes of huge jobs don't relist the bucket every time.
+    A cached listing is a snapshot: it misses outputs committed since
+    (causing harmless re-renders), but still holds outputs deleted
+    since, whose tasks are then skipped.  Pass refresh=True (or set
+    RESUME_CACHE_TTL to 0) to list the bucket afresh.
+    Names transcoded by brenda-node are returned without their
+    TRANSCODE_<EXT>_SUFFIX, i.e. as the task wrote them.
+    """
+    def cached(kind, what, list_fn):
+        fn = cache_file_name(conf, kind, conf.get('RENDER_OUTPUT', ''))
+        try:
+            if not refresh and time.time() - os.path.getmtime(fn) < cache_ttl:
+                with open(fn) as f:
+                    names = f.read().splitlines()
+                print "Resume: using cached listing of %s (%d names)" % (what, len(names))
+                return names
+        except (OSError, IOError):
+            pass
+        names = list_fn(conf)
+        print "Resume: listed %s (%d names)" % (what, len(names))
+        utils.write_atomic(fn, ''.join([n + '\n' for n in names]))
+        return names
+
+    def strip_suffixes(names):
+        suffixes = transcode.transcode_suffixes(conf)
+        if not suffixes:
+            return names
+        ret = []
+        for name in names:
+            for suffix in suffixes:
+                if name.endswith(suffix):
+                    name = name[:-len(suffix)]
+                    break
+            ret.append(name)
+        return ret
+
+    cache_ttl = int(conf.get('RESUME_CACHE_TTL', '600'))
+    names = cached('output', 'RENDER_OUTPUT', aws.list_s3_output_names)
+    names += cached('shards', 'output shards', shard.list_shard_members)
+    return strip_suffixes(names)
+
+def iter_task_macros(opts, task_script, output_names=None):
+    """
+    Generate the macro dictionary of each task in the job, with
+    the resume and randomize options of iter_tasks applied.
+    """
+    if (getattr(opts, 'sample_split', 0) and not getattr(opts, 'samples', None)
+        and '$SAMPLES' in TaskTemplate(task_script).macros()):
+        raise ValueError("task script uses $SAMPLES, so --sample-split requires --samples")
+    macros = task_macro_iterator(opts)
+    if output_names is not None:
+        matcher = OutputMatcher(output_pattern(opts, task_script), output_names)
+        macros = (m for m in macros if not matcher.task_done(m))
+    if getattr(opts, 'randomize', False):
+        if (getattr(opts, 'order', None) or 'frame') != 'frame':
+            raise ValueError("--randomize cannot be combined with --order=%s" % (opts.order,))
+        macros = shuffle_iterator(macros, getattr(opts, 'shuffle_buffer', SHUFFLE_BUFFER))
+    return macros
+
+def iter_tasks(opts, task_script, output_names=None):
+    """
+    Generate the task scripts for a job, one at a time, so that
+    memory use stays flat regardless of job size.  opts is any
+    object with the brenda-work option attributes (start, end,
+    task_size, subdiv_x, subdiv_y, randomize, shuffle_buffer,
+    order, cost_file, target_task_time, task_overhead,
+    tile_cost_map, sample_split, samples, output_pattern), such
+    as optparse.Values; missing optional attributes take their
+    brenda-work defaults.  task_script is the text of the task
+    script template.  If output_names (the object names under
+    RENDER_OUTPUT) is given, tasks whose outputs are all present
+    are skipped.
+    """
+    template = TaskTemplate(task_script)
+    for m in iter_task_macros(opts, task_script, output_names):
+        yield template.expand(m)
+
+def iter_task_records(opts, task_script, job_id, output_names=None, then_script=None, final_script=None):
+    """
+    Like iter_tasks, but generate compact task records for job_id
+    (see brenda.job) holding only the macro values referenced by
+    the task script, rather than the expanded scripts themselves.
+    The task script must be stored with job.put_job_template.
+
+    then_script and final_script, if given, are the templates of
+    dependent tasks, stored under the names 'then-script' and
+    'final-script'.  A then-script task (such as a tile stitch)
+    is released for each frame range as soon as all tasks of the
+    frame range have committed.  The final-script task (such as
+    an encode) is released once all then-script tasks, or if
+    there are none, all tasks of the job have committed.
+    """
+    def used_macros(template, m):
+        return dict([(k, v) for k, v in m.iteritems() if k in template.macros()])
+
+    def task_id(m):
+        return hashlib.sha1(json.dumps(m, sort_keys=True)).hexdigest()[:20]
+
+    template = TaskTemplate(task_script)
+    final_record = None
+    then_template = None
+    n_variants = len(task_variants(opts))
+    if final_script is not None:
+        # index of each frame range, to spread then-script tasks over gates
+        ranges = dict([("%d-%d-%d" % r, i) for i, r in enumerate(frame_range_iterator(opts))])
+        if then_script is not None:
+            n_final = len(ranges)
+        else:
+            n_final = len(ranges) * n_variants
+        final_record = job.task_record(job_id,
+                                       used_macros(TaskTemplate(final_script), frame_range_macros(opts.start, opts.end, 1)),
+                                       id='final', script='final-script')
+    if then_script is not None:
+        then_template = TaskTemplate(then_script)
+    if (then_script is not None or final_script is not None) and output_names is not None:
+        raise ValueError("--resume cannot be combined with dependent tasks")
+
+    for i, m in enumerate(iter_task_macros(opts, task_script, output_names)):
+        record = job.task_record(job_id, used_macros(template, m))
+        if then_template is not None:
+            range_id = "%s-%s-%s" % (m['$START'], m['$END'], m['$STEP'])
+            then_record = job.task_record(job_id, used_macros(then_template, m),
+                                          id="then-" + range_id,
+                                          script='then-script')
+            if final_record is not None:
+                then_record['then'] = [job.fan_in(final_record, n_final, ranges[range_id])]
+            record['id'] = task_id(m)
+            record['then'] = [job.dependent(then_record, n_variants)]
+        elif final_record is not None:
+            record['id'] = task_id(m)
+            record['then'] = [job.fan_in(final_record, n_final, i)]
+        yield job.encode_task_record(record)
+
 def push(opts, args, conf):
     # get task script
     with open(opts.task_script) as f:
         task_script = f.read()
 
-    # build tasklist
-    tasklist = []
-    for fnum in xrange(opts.start, opts.end+1, opts.task_size):
-        script = task_script
-        start = fnum
-        end = min(fnum + opts.task_size - 1, opts.end)
-        step = 1
-        for key, value in (
-              ("$FRAME", "-s %d -e %d -j %d" % (start, end, step)),
-              ("$START", "%d" % (start,)),
-              ("$END", "%d" % (end,)),
-              ("$STEP", "%d" % (step,))
-              ):
-            script = script.replace(key, value)
-        if subframe_iterator_defined(opts):
-            for macro_list in subframe_iterator(opts):
-                sf_script = script
-                for key, value in macro_list:
-                    sf_script = sf_script.replace(key, value)
-                tasklist.append(sf_script)
-        else:
-            tasklist.append(script)
+    # if resuming, get the list of outputs that were already rendered
+    output_names = None
+    if getattr(opts, 'resume', False):
+        output_names = get_render_output_names(conf, getattr(opts, 'resume_refresh', False))
+
+    # get dependent task scripts
+    dependent_scripts = {}
+    for name in ('then_script', 'final_script'):
+        fn = getattr(opts, name, None)
+        if fn:
+            with open(fn) as f:
+                dependent_scripts[name] = f.read()
 
-    # possibly randomize the task list
-    if opts.randomize:
-        random.shuffle(tasklist)
+    # task generator (dependent tasks require compact task records)
+    if getattr(opts, 'compact', False) or dependent_scripts:
+        job_id = getattr(opts, 'job_id', None) or job.new_job_id()
+        print "Job ID:", job_id
+        if not opts.dry_run:
+            job.put_job_template(conf, job_id, task_script)
+            for name, script in dependent_scripts.iteritems():
+                job.put_job_template(conf, job_id, script, name.replace('_', '-'))
+        tasks = iter_task_records(opts, task_script, job_id, output_names, **dependent_scripts)
+    else:
+        tasks = iter_tasks(opts, task_script, output_names)
 
     # get work queue
     q = None
+    lane = get_lane(opts)
     if not opts.dry_run:
-        q = aws.create_sqs_queue(conf)
+        q = aws.create_sqs_queue(conf, lane)
 
     # push work queue to sqs
-    for task in tasklist:
-        print task,
-        if q is not None:
-            aws.write_sqs_queue(task, q)
+    if q is not None:
+        push_tasks(conf, tasks, lane)
+    else:
+        for task in tasks:
+            print utils.str_nl(task),
+
+def push_tasks(conf, tasks, lane=None):
+    """
+    Push task scripts to the SQS work queue (of the given lane)
+    using SendMessageBatch, spreading the batches over a pool of
+    PUSH_THREADS sender threads.  Only the entries of a batch that
+    SQS rejected are retried.
+    """
+    def worker():
+        # boto connections are not thread-safe, so each
+        # sender thread uses its own connection.  On error, keep
+        # draining batch_q until the sentinel, so that the main
+        # thread never blocks on a full queue.
+        q = None
+        while True:
+            batch = batch_q.get()
+            try:
+                if batch is None:
+                    break
+                if not errors:
+                    if q is None:
+                        q = aws.get_sqs_queue(conf, lane)
+                    send_batch(q, batch)
+            except Exception, e:
+                with lock:
+                    errors.append(e)
+            finally:
+                batch_q.task_done()
+
+    def send_batch(q, batch):
+        def action():
+            pending[:] = aws.write_sqs_queue_batch(pending, q)
+            if pending:
+                raise error.ValueErrorRetry("SQS rejected %d of %d messages in batch" % (len(pending), len(batch)))
+
+        pending = list(batch)
+        error.retry(conf, action)
+        with lock:
+            stats['sent'] += len(batch)
+
+    def encoded_tasks():
+        for task in tasks:
+            print utils.str_nl(task),
+            yield aws.encode_sqs_body(task)
+
+    n_threads = int(conf.get('PUSH_THREADS', '8'))
+    batch_q = Queue.Queue(maxsize=n_threads*4)
+    lock = threading.Lock()
+    errors = []
+    stats = { 'sent' : 0 }
+
+    threads = []
+    for i in xrange(n_threads):
+        t = threading.Thread(target=worker)
+        t.daemon = True
+        t.start()
+        threads.append(t)
+
+    start_time = time.time()
+    try:
+        for batch in aws.sqs_batch_iterator(encoded_tasks()):
+            if errors:
+                break
+            batch_q.put(batch)
+    finally:
+        for t in threads:
+            batch_q.put(None)
+        for t in threads:
+            t.join()
+    elapsed = time.time() - start_time
+
+    if errors:
+        raise errors[0]
+    print "Pushed %d tasks in %.2f seconds (%.1f tasks/sec)" % (
+        stats['sent'], elapsed, stats['sent'] / max(elapsed, 0.001))
+
+def get_lane(opts):
+    """
+    Return the work queue lane selected by --lane (given as
+    a queue name or sqs:// URL), or None if not selected.
+    """
+    lane = getattr(opts, 'lane', None)
+    if lane:
+        return aws.parse_sqs_url(lane) or lane
+
+def selected_lanes(opts, conf):
+    """
+    Return the lanes that status and reset act on: the
+    lane selected by --lane, otherwise all lanes.
+    """
+    lane = get_lane(opts)
+    if lane:
+        return [aws.get_sqs_work_queue_name(conf, lane)]
+    return aws.get_sqs_work_queue_names(conf)
 
 def status(opts, args, conf):
-    q = aws.get_sqs_queue(conf)
-    if q is not None:
-        print "Queued tasks:", q.count()
+    lanes = []
+    for lane in selected_lanes(opts, conf):
+        q = aws.get_sqs_queue(conf, lane)
+        if q is not None:
+            lanes.append((lane, q, cache_file_name(conf, 'status', lane)))
+    while lanes:
+        for lane, q, history_fn in lanes:
+            if len(lanes) > 1:
+                print "------- Lane", lane
+            queue_status(opts, q, history_fn)
+        if not getattr(opts, 'watch', None):
+            break
+        time.sleep(opts.watch)
+        print
+
+def get_queue_counts(q):
+    """
+    Return a (queued, in_flight, delayed) tuple of approximate
+    message counts for SQS queue q.
+    """
+    a = q.get_attributes('All')
+    return (int(a.get('ApproximateNumberOfMessages', 0)),
+            int(a.get('ApproximateNumberOfMessagesNotVisible', 0)),
+            int(a.get('ApproximateNumberOfMessagesDelayed', 0)))
+
+def read_status_history(fn, since):
+    samples = []
+    try:
+        with open(fn) as f:
+            for line in f.readlines():
+                try:
+                    sample = tuple([float(v) for v in line.split()])
+                except ValueError:
+                    continue
+                if len(sample) == 4 and sample[0] >= since:
+                    samples.append(sample)
+    except IOError:
+        pass
+    return samples
+
+def queue_status(opts, q, history_fn):
+    """
+    Show queued, in-flight and delayed task counts of q, along
+    with the drain rate and estimated completion time.  The rate
+    is computed over the last --rate-window minutes of samples
+    persisted in history_fn by previous status calls; if there
+    is no usable history, counts are sampled over --sample seconds.
+    """
+    history_max = 86400
+    window = getattr(opts, 'rate_window', 10.0) * 60
+    sample_period = getattr(opts, 'sample', 15.0)
+
+    now = time.time()
+    samples = read_status_history(history_fn, now - history_max)
+    counts = get_queue_counts(q)
+    samples.append((now,) + counts)
+
+    recent = [sm for sm in samples if sm[0] >= now - window]
+    if now - recent[0][0] < sample_period and sample_period > 0 and not getattr(opts, 'watch', None):
+        print "Sampling queue for %d seconds..." % (sample_period,)
+        time.sleep(sample_period)
+        now = time.time()
+        counts = get_queue_counts(q)
+        samples.append((now,) + counts)
+        recent.append(samples[-1])
+
+    utils.write_atomic(history_fn, ''.join(["%.1f %d %d %d\n" % sm for sm in samples]))
+
+    queued, in_flight, delayed = counts
+    remaining = queued + in_flight + delayed
+    print "Queued tasks:", queued
+    print "In-flight tasks:", in_flight
+    print "Delayed tasks:", delayed
+
+    first = recent[0]
+    elapsed = now - first[0]
+    if elapsed <= 0:
+        print "Drain rate: unknown (need more samples)"
+        return
+    rate = (sum(first[1:]) - remaining) / elapsed * 60
+    print "Drain rate: %.1f tasks/min (over last %.1f minutes)" % (rate, elapsed / 60)
+    if remaining == 0:
+        print "ETA: done"
+    elif rate > 0:
+        eta = remaining / rate * 60
+        print "ETA: %s (%s)" % (aws.format_uptime(int(eta)),
+                                time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(now + eta)))
+    else:
+        print "ETA: unknown (queue is not draining)"
+
+def dead_letter_iterator(conf, dlq):
+    """
+    Yield the messages of dead-letter queue dlq along with their
+    decoded quarantine records (see brenda.node), hiding each
+    message for a while so that the iteration terminates.
+    Records too large for SQS are read from the job store.
+    """
+    while True:
+        msgs = dlq.get_messages(10, visibility_timeout=60)
+        if not msgs:
+            break
+        for m in msgs:
+            dead = json.loads(m.get_body())
+            if 'stored' in dead:
+                dead = json.loads(job.get_job_template(conf, job.DEAD_LETTER_JOB, dead['stored']))
+            # json returns unicode, but task scripts are byte strings
+            for k in ('body', 'stderr_tail'):
+                dead[k] = dead[k].encode('utf-8')
+            yield m, dead
+
+def dead_letter_queues(opts, conf):
+    """
+    Return the existing dead-letter queues of the selected lanes
+    (several lanes may share one DEAD_LETTER_QUEUE).
+    """
+    dlqs = []
+    names = set()
+    for lane in selected_lanes(opts, conf):
+        name = aws.get_sqs_dead_letter_queue_name(conf, lane)
+        if name not in names:
+            names.add(name)
+            dlq = aws.get_sqs_dead_letter_queue(conf, lane)
+            if dlq is not None:
+                dlqs.append(dlq)
+    return dlqs
+
+def quarantine(opts, args, conf):
+    for dlq in dead_letter_queues(opts, conf):
+        print "------- Dead-letter queue", dlq.name
+        seen = []
+        for m, dead in dead_letter_iterator(conf, dlq):
+            seen.append(m)
+            print "******* TASK from %s, received %d times, failed with status %s on %s at %s" % (
+                dead['queue'], dead['receive_count'], dead['retcode'], dead['node'],
+                time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(dead['time'])))
+            print utils.str_nl(dead['body']),
+            print "------- stderr tail"
+            print utils.str_nl(dead['stderr_tail']),
+        print "Quarantined tasks:", len(seen)
+
+        # make the listed messages visible again
+        for m in seen:
+            m.change_visibility(0)
+
+def redrive(opts, args, conf):
+    for dlq in dead_letter_queues(opts, conf):
+        queues = {}
+        n = 0
+        for m, dead in dead_letter_iterator(conf, dlq):
+            print "REDRIVE to %s:" % (dead['queue'],), utils.str_nl(dead['body']),
+            if not opts.dry_run:
+                q = queues.get(dead['queue'])
+                if q is None:
+                    q = queues[dead['queue']] = aws.get_sqs_queue(conf, dead['queue'])
+                aws.write_sqs_queue(dead['body'], q)
+                dlq.delete_message(m)
+            n += 1
+        print "Re-driven tasks from %s: %d" % (dlq.name, n)
+
+def fetch(opts, args, conf):
+    shard.fetch(conf, opts.fetch_dir, args[1:])
 
 def reset(opts, args, conf):
-    q, conn = aws.get_sqs_conn_queue(conf)
-    if q:
-        if opts.hard:
-            conn.delete_queue(q)
-        else:
-            q.clear()
+    # Clearing every lane would be a surprise to a user who only
+    # pushes to the first one, so make them choose a lane.
+    lanes = selected_lanes(opts, conf)
+    if len(lanes) > 1:
+        raise ValueError("WORK_QUEUE has %d lanes, select the lane to reset with --lane" % (len(lanes),))
+    for lane in lanes:
+        q, conn = aws.get_sqs_conn_queue(conf, lane)
+        if q:
+            if opts.hard:
+                conn.delete_queue(q)
+            else:
+                q.clear()
@@ -0,0 +1,85 @@
+# Merge the partial renders of a sample-split job (brenda-work
+# --sample-split) into a single frame, by averaging the partial
+# EXRs weighted by their sample counts.  Partials are expected to
+# follow the naming of task-scripts/samplesplit, i.e.
+#   frame_000001_S-INDEX-COUNT-SAMPLES.exr
+# from which the sample count of each partial is taken.  Partials
+# compressed by a brenda-node TRANSCODE_EXR command, e.g.
+#   frame_000001_S-INDEX-COUNT-SAMPLES.exr.zst
+# are decompressed with the tool named by their suffix (see
+# DECOMPRESS).
+#
+# Usage: python merge.py OUTPUT.exr PARTIAL.exr [PARTIAL.exr ...]
+#
+# Requires the OpenEXR and numpy Python modules.
+
+import sys, re, subprocess, tempfile
+import numpy
+import OpenEXR, Imath
+
+re_samples = re.compile(r"_S-\d+-\d+-(\d+)\.exr(\.\w+)?$")
+
+# decompression tool for each compressed partial suffix
+DECOMPRESS = {
+    '.zst' : 'zstd',
+    '.gz'  : 'gzip',
+    '.bz2' : 'bzip2',
+    '.xz'  : 'xz',
+    '.lz4' : 'lz4',
+    }
+
+def samples(fn):
+    m = re.search(re_samples, fn)
+    if not m:
+        raise ValueError("cannot determine sample count of %r" % (fn,))
+    return int(m.group(1))
+
+def open_partial(fn):
+    """
+    Return an OpenEXR.InputFile for partial fn,
+    decompressing it first if needed.
+    """
+    suffix = re.search(re_samples, fn).group(2)
+    if not suffix:
+        return OpenEXR.InputFile(fn)
+    tool = DECOMPRESS.get(suffix)
+    if not tool:
+        raise ValueError("don't know how to decompress %r" % (fn,))
+    with tempfile.NamedTemporaryFile(suffix='.exr') as tmp:
+        subprocess.check_call([tool, '-d', '-c', fn], stdout=tmp)
+        tmp.flush()
+        return OpenEXR.InputFile(tmp.name)
+
+def main():
+    if len(sys.argv) < 3:
+        print >>sys.stderr, "usage: %s OUTPUT.exr PARTIAL.exr [PARTIAL.exr ...]" % (sys.argv[0],)
+        sys.exit(2)
+    out_fn = sys.argv[1]
+    partials = sys.argv[2:]
+
+    float_type = Imath.PixelType(Imath.PixelType.FLOAT)
+    header = None
+    acc = {}
+    total = 0
+    for fn in partials:
+        weight = samples(fn)
+        exr = open_partial(fn)
+        h = exr.header()
+        if header is None:
+            header = h
+        for ch in h['channels']:
+            data = numpy.fromstring(exr.channel(ch, float_type), dtype=numpy.float32).astype(numpy.float64)
+            if ch in acc:
+                acc[ch] += data * weight
+            else:
+                acc[ch] = data * weight
+        total += weight
+        print "MERGE", fn, "samples=%d" % (weight,)
+
+    header['channels'] = dict([(ch, Imath.Channel(float_type)) for ch in acc])
+    out = OpenEXR.OutputFile(out_fn, header)
+    out.writePixels(dict([(ch, (data / total).astype(numpy.float32).tostring()) for ch, data in acc.iteritems()]))
+    out.close()
+    print "WROTE", out_fn, "samples=%d" % (total,)
+
+main()
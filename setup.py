@@ -20,7 +20,7 @@ setup(name = "Brenda",
       scripts = [ 'brenda-work', 'brenda-tool', 'brenda-run', 'brenda-node', 'brenda-ebs' ],
       ext_modules = ext_modules,
 
-      data_files=[('brenda/task-scripts', ['task-scripts/frame', 'task-scripts/subframe']),
+      data_files=[('brenda/task-scripts', ['task-scripts/frame', 'task-scripts/subframe', 'task-scripts/samplesplit']),
                   ('brenda/doc', ['README.md', 'doc/brenda-talk-blendercon-2013.pdf'])],
 
       author = "James Yonan",